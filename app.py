@@ -14,11 +14,11 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 from argparse import Namespace
-import glob
 
 import logging
 import os
 import queue
+import threading
 
 import tkFileDialog
 from tkinter import (
@@ -34,12 +34,14 @@ from tkinter import (
     IntVar,
     N, NW, NE, S, E, W,
     X, LEFT, RIGHT, BOTH, END,
+    DISABLED, NORMAL,
 )
 from tkinter.scrolledtext import ScrolledText
 import traceback
 import ttk
 
-from tdconv.tdconv import convert, determine_target_directory
+from tdconv.progress import ConversionCancelled, Progress
+from tdconv.tdconv import ConversionError, convert, determine_target_directory
 
 from setup import VERSION
 
@@ -69,9 +71,15 @@ class App:
 
     TARGET_FORMAT_FRAME_LABEL = "Convert to:"
 
+    # ms between checks whether the conversion has finished
+    POLL_INTERVAL = 100
+
     def __init__(self, master):
 
+        self.master = master
         self.source_type = None
+        self.worker = None
+        self.progress = None
         self.build_gui(master)
 
     def build_gui(self, master):
@@ -96,6 +104,8 @@ class App:
         buttons_frame.pack(anchor=NW, fill=X)
         self.button_convert = Button(buttons_frame, text="Convert", command=self.convert)
         self.button_convert.pack(anchor=NW, side=LEFT)
+        self.button_cancel = Button(buttons_frame, text="Cancel", command=self.cancel, state=DISABLED)
+        self.button_cancel.pack(anchor=NW, side=LEFT)
 
         logger_frame = LabelFrame(master, text="Converter Output:", padx=5, pady=5)
         logger_frame.pack(anchor=NW, fill=X, padx=10, pady=10)
@@ -245,7 +255,7 @@ class App:
         self.dirname.set(dirname)
 
     def convert(self):
-        """Trigger conversion of source(s) to desired target format."""
+        """Trigger conversion of source(s) to desired target format in the background."""
         logger.setLevel('INFO')
         # logger.setLevel('DEBUG')
         logger.info("starting conversion...")
@@ -260,38 +270,67 @@ class App:
             logger.debug("target format: %s" % target_format)
             output = make_target_filename(source, self.output_file.get(), target_format)
             download_attachments = self.download.get()
-            self.tdconv(source, target_format, output, download_attachments)
+            conversions = [(source, target_format, output, download_attachments)]
         elif nb_idx == self.DIRECTORY_CONVERSION_TAB:
             logger.debug("directory tab")
             source = self.dirname.get()
-            source_filter = self.dir_source_format.get()
-            target_format = self.dir_target_format.get()
+            if not os.path.isdir(source):
+                raise Exception("Source '%s' is not a directory" % source)
+            if self.dir_source_format.get() == self.FMT_OPML[1]:
+                target_format = self.FMT_CSV[1]
+            else:
+                target_format = self.dir_target_format.get()
             download_attachments = self.dir_download_attachments.get()
-            self.process_directory(source, source_filter, target_format, download_attachments)
+            # the files of the directory are converted one after the other, see tdconv()
+            conversions = [(source, target_format, make_target_filename(source, '', target_format),
+                            download_attachments)]
         else:
             raise Exception("unknown tab %s" % nb_idx)
 
-        logger.info("ready")
-
-    def process_directory(self, source, source_filter, target_format, download_attachments):
-        """Process all files in a directory that match source_filter"""
-        if not os.path.isdir(source):
-            raise Exception("Source '%s' is not a directory" % source)
-
-        ext = source_filter
-        if source_filter == 'todoist':
-            ext = 'csv'
-        pattern = '*.%s' % ext
-        source_files = glob.glob(os.path.join(source, pattern))
+        self.start_worker(conversions)
+
+    def start_worker(self, conversions):
+        """
+        Run conversions in a background thread, so the window stays
+        responsive. Progress is logged to the console, Cancel stops the
+        conversion at the next checkpoint.
+        """
+        self.progress = Progress(callback=lambda progress: logger.info("progress: %s" % progress))
+        # zip files and directories add their files when they are opened
+        self.progress.add_files(len([c for c in conversions
+                                     if not c[0].lower().endswith('.zip') and not os.path.isdir(c[0])]))
+        self.worker = threading.Thread(target=self.run_conversions, args=(conversions, self.progress))
+        self.worker.daemon = True
+        self.button_convert.configure(state=DISABLED)
+        self.button_cancel.configure(state=NORMAL)
+        self.worker.start()
+        self.master.after(self.POLL_INTERVAL, self.poll_worker)
+
+    def run_conversions(self, conversions, progress):
+        """Convert all sources (in the worker thread)."""
+        try:
+            for source, target_format, output, download_attachments in conversions:
+                progress.checkpoint()
+                self.tdconv(source, target_format, output, download_attachments, progress)
+        except ConversionCancelled:
+            logger.warning("conversion cancelled (%s)" % progress)
+        else:
+            logger.info("ready (%s)" % progress)
 
-        if source_files:
-            for s in source_files:
-                o = make_target_filename(s, '', target_format)
-                self.tdconv(s, target_format, o, download_attachments)
+    def poll_worker(self):
+        if self.worker.is_alive():
+            self.master.after(self.POLL_INTERVAL, self.poll_worker)
         else:
-            logger.error("No files matching pattern '%s' in directory '%s'" % (pattern, source))
+            self.worker = None
+            self.button_convert.configure(state=NORMAL)
+            self.button_cancel.configure(state=DISABLED)
+
+    def cancel(self):
+        if self.progress:
+            logger.info("cancelling...")
+            self.progress.cancel()
 
-    def tdconv(self, source, target_format, output, download_attachments):
+    def tdconv(self, source, target_format, output, download_attachments, progress=None):
         """Call tdconv to convert a file."""
         # make sure source exists
         if not source:
@@ -308,10 +347,17 @@ class App:
         args = Namespace(file=source,
                          format=target_format,
                          output=output,
-                         download=download_attachments)
+                         download=download_attachments,
+                         progress=progress,
+                         # no worker processes: in the bundled app they would start the app again
+                         jobs=1)
         try:
-            pass
             convert(args)
+        except ConversionCancelled:
+            raise
+        except ConversionError as e:
+            # the errors of every file have been logged already
+            logger.error(e)
         except Exception:
             tb = traceback.format_exc()
             logger.error(tb)
@@ -29,7 +29,7 @@ if __name__ == "__main__":
         test_suite="nose.collector",
         entry_points={
             'console_scripts': [
-                'tdconv = tdconv.tdconv:main',
+                'tdconv = tdconv:main',
             ],
         }
     )
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import unicode_literals
+
+import sys
+
+# The converters are imported on first use, so tdconv submit (see client)
+# starts without them.
+
+
+def convert(args):
+    """See tdconv.tdconv.convert()."""
+    from .tdconv import convert
+    return convert(args)
+
+
+def convert_stream(*args, **kwargs):
+    """See tdconv.tdconv.convert_stream()."""
+    from .tdconv import convert_stream
+    return convert_stream(*args, **kwargs)
+
+
+def main():
+    """Entry point of the tdconv command."""
+    if sys.argv[1:2] == ['submit']:
+        from .client import main as submit
+        return submit(sys.argv[2:])
+    from .tdconv import main
+    return main()
@@ -0,0 +1,234 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from download import stream_to_file
+
+
+logger = logging.getLogger("tdconv")
+
+DEFAULT_CACHE_SIZE = 1024 * 1024 * 1024
+
+
+class AttachmentCache(object):
+    """
+    Persistent cache for downloaded attachments.
+
+    Every file is stored once per content hash in <directory>/objects, the
+    index maps each file_url to the hash of its contents, its ETag and
+    Last-Modified headers and the time it was last used. Attachments are
+    hard-linked from the cache into the attachments dir where possible, so
+    a cached file is checked against its hash before it's used: an
+    attachment that was edited in place is downloaded again.
+
+    Cached URLs are used without any network access, unless revalidate is
+    set, in which case a conditional request is sent for every URL. When the
+    cache grows beyond max_size, least recently used entries are evicted.
+
+    Several processes may share a cache directory: objects are content
+    addressed and the index is replaced atomically, so in the worst case an
+    index entry is lost and the file is downloaded again.
+    """
+    INDEX = 'index.json'
+    OBJECTS = 'objects'
+
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE, revalidate=False):
+        self.directory = directory
+        self.objects = os.path.join(directory, self.OBJECTS)
+        self.max_size = max_size
+        self.revalidate = revalidate
+        self.lock = threading.Lock()
+        self.url_locks = {}
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(self.objects):
+            os.makedirs(self.objects)
+        self.entries = self._load_index()
+
+    def fetch(self, url, filename, pool, chunk_size, meter=None):
+        """Put the contents of url into filename, from the cache if possible."""
+        with self._url_lock(url):
+            entry = self._lookup(url)
+            if entry and not self.revalidate:
+                self._use(url, entry, filename)
+                return
+            response = pool.open(url, headers=self._conditional_headers(entry))
+            if entry and getattr(response, 'status', 200) == 304:
+                response.read()
+                self._use(url, entry, filename)
+                return
+            with self.lock:
+                self.misses += 1
+            digest = hashlib.sha1()
+            tmp = os.path.join(self.objects, 'incoming-%s-%s' % (os.getpid(), threading.current_thread().ident))
+            stream_to_file(response, tmp, chunk_size, meter, digest)
+            key = digest.hexdigest()
+            blob = self._blob(key)
+            if os.path.exists(blob):
+                os.remove(tmp)
+            else:
+                os.rename(tmp, blob)
+            entry = dict(hash=key,
+                         size=os.path.getsize(blob),
+                         etag=response_header(response, 'etag'),
+                         last_modified=response_header(response, 'last-modified'))
+            with self.lock:
+                self.entries[url] = entry
+            self._use(url, entry, filename, hit=False)
+
+    def find(self, url, filenames):
+        """
+        Return the first of filenames that already has the cached contents
+        of url, or None. Used to keep an attachment of an earlier run instead
+        of downloading it next to itself.
+        """
+        if self.revalidate:
+            return None
+        with self.lock:
+            entry = self.entries.get(url)
+        if not entry:
+            return None
+        for filename in filenames:
+            try:
+                if os.path.getsize(filename) != entry['size'] or file_digest(filename) != entry['hash']:
+                    continue
+            except (OSError, IOError):
+                continue
+            with self.lock:
+                self.hits += 1
+                entry['used'] = time.time()
+            return filename
+        return None
+
+    def save(self):
+        """Evict least recently used entries and write the index."""
+        with self.lock:
+            self._evict()
+            fd, tmp = tempfile.mkstemp(suffix='.part', dir=self.directory)
+            with os.fdopen(fd, 'wb') as f:
+                json.dump(dict(version=1, urls=self.entries), f)
+            os.rename(tmp, os.path.join(self.directory, self.INDEX))
+
+    def clear(self):
+        """Remove all entries and cached files."""
+        with self.lock:
+            self.entries = {}
+            shutil.rmtree(self.objects)
+            os.makedirs(self.objects)
+        self.save()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.directory, self.INDEX), 'rb') as f:
+                return json.load(f)['urls']
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except (ValueError, KeyError):
+            logger.warning("ignoring corrupt attachment cache index in '%s'" % self.directory)
+        return {}
+
+    def _lookup(self, url):
+        """Return the index entry for url if its file is still present and intact."""
+        with self.lock:
+            entry = self.entries.get(url)
+        if not entry:
+            return None
+        blob = self._blob(entry['hash'])
+        try:
+            if os.path.getsize(blob) == entry['size'] and file_digest(blob) == entry['hash']:
+                return entry
+        except (OSError, IOError):
+            return None
+        logger.warning("cached file of '%s' was changed, downloading it again" % url)
+        with self.lock:
+            self.entries.pop(url, None)
+        try:
+            os.remove(blob)
+        except OSError:
+            pass
+        return None
+
+    def _use(self, url, entry, filename, hit=True):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            entry['used'] = time.time()
+        link_or_copy(self._blob(entry['hash']), filename)
+
+    def _conditional_headers(self, entry):
+        headers = {}
+        if entry:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def _evict(self):
+        sizes = {}
+        references = {}
+        for entry in self.entries.values():
+            sizes[entry['hash']] = entry['size']
+            references[entry['hash']] = references.get(entry['hash'], 0) + 1
+        total = sum(sizes.values())
+        by_use = sorted(self.entries.items(), key=lambda item: item[1].get('used', 0))
+        for url, entry in by_use:
+            if total <= self.max_size:
+                break
+            del self.entries[url]
+            key = entry['hash']
+            references[key] -= 1
+            if not references[key]:
+                total -= entry['size']
+                try:
+                    os.remove(self._blob(key))
+                except OSError:
+                    pass
+
+    def _blob(self, key):
+        return os.path.join(self.objects, key)
+
+    def _url_lock(self, url):
+        with self.lock:
+            return self.url_locks.setdefault(url, threading.Lock())
+
+
+def response_header(response, name):
+    """Return a header of an httplib or urllib2 response."""
+    if hasattr(response, 'getheader'):
+        return response.getheader(name)
+    return response.info().getheader(name)
+
+
+def file_digest(filename, chunk_size=64 * 1024):
+    """Return the sha1 hex digest of the contents of filename."""
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(source, filename):
+    """Replace filename with a hard link to source (or a copy if linking fails)."""
+    dirname, basename = os.path.split(filename)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.part', dir=dirname or '.')
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        os.link(source, tmp)
+    except (OSError, AttributeError):
+        shutil.copyfile(source, tmp)
+    os.rename(tmp, filename)
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+
+
+def submit(path, requests):
+    """
+    Send requests to the server on UNIX socket path, yield its responses.
+    Requests are sent from a thread while the responses are read, so
+    neither side blocks on a full socket buffer.
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+        sender = threading.Thread(target=_send, args=(client, requests))
+        sender.daemon = True
+        sender.start()
+        responses = client.makefile('rb')
+        for line in iter(responses.readline, b''):
+            yield json.loads(line)
+        responses.close()
+        sender.join()
+    finally:
+        client.close()
+
+
+def _send(client, requests):
+    f = client.makefile('wb')
+    try:
+        for request in requests:
+            f.write(json.dumps(request).encode('utf-8') + b'\n')
+        f.flush()
+    finally:
+        f.close()
+        client.shutdown(socket.SHUT_WR)
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(
+        prog='tdconv submit',
+        usage='%(prog)s --socket PATH [tdconv options] file [file ...]',
+        description='Convert files in a running tdconv serve --socket PATH, with the same options as tdconv '
+                    '(see tdconv --help).')
+    parser.add_argument('--socket', required=True, metavar='PATH',
+                        help='UNIX socket of a running tdconv serve --socket PATH')
+    return parser
+
+
+def main(argv):
+    """
+    tdconv submit --socket PATH [options] FILE...
+
+    This module imports nothing but the standard library, so submitting
+    files doesn't pay for the imports the server saves. The options and
+    files are parsed (and validated) by the server.
+    """
+    args, argv = make_parser().parse_known_args(argv)
+    # one response per file
+    request = dict(id=0, argv=argv, cwd=os.getcwd())
+    failed = 0
+    for response in submit(args.socket, [request]):
+        if response['ok']:
+            print('%s: converted in %.2f seconds' % (response['file'], response['seconds']))
+        else:
+            failed += 1
+            print('%s: %s' % (response.get('file') or 'tdconv submit', response['error']), file=sys.stderr)
+    if failed:
+        sys.exit(1)
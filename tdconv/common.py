@@ -3,35 +3,100 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-from collections import namedtuple
+import csv
+import itertools
 import logging
 import os.path
 import re
 
-from const import FIELDNAMES
-from unicode_csv import UnicodeReader
+from cache import AttachmentCache, DEFAULT_CACHE_SIZE
+from download import DownloadScheduler, DEFAULT_DOWNLOAD_BUFFER, DEFAULT_DOWNLOAD_THREADS
+from unicode_csv import skip_bom
 
 from note import Note
+from outline_cache import OutlineCache, DEFAULT_OUTLINE_CACHE_SIZE
+from sink import KeepOpen, OutputSink
 
 
 logger = logging.getLogger("tdconv")
 
 
+def _field(index, slot):
+    """Property that decodes cell index of a Row once and keeps it in slot."""
+    def get(self):
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            cells = self._cells
+            value = cells[index].decode(Row.ENCODING) if index < len(cells) else ''
+            setattr(self, slot, value)
+            return value
+    return property(get)
+
+
+class Row(object):
+    """
+    One row of a Todoist CSV file, with the fields in const.FIELDNAMES as
+    (lowercase) attributes.
+
+    The row keeps the encoded cells as read by the csv module, a field is
+    decoded when it's first accessed and kept in its slot, so columns nobody
+    reads are never decoded (and their slots stay empty).
+    """
+    __slots__ = ('_cells', '_type', '_content', '_priority', '_indent', '_author', '_responsible', '_date',
+                 '_date_lang', '_timezone')
+    ENCODING = 'utf-8'
+
+    def __init__(self, cells):
+        self._cells = cells
+
+    @classmethod
+    def _make(cls, cells):
+        return cls(cells)
+
+    type = _field(0, '_type')
+    content = _field(1, '_content')
+    priority = _field(2, '_priority')
+    indent = _field(3, '_indent')
+    author = _field(4, '_author')
+    responsible = _field(5, '_responsible')
+    date = _field(6, '_date')
+    date_lang = _field(7, '_date_lang')
+    timezone = _field(8, '_timezone')
+
+
 class Converter(object):
 
     TYPE_TASK = 'task'
     TYPE_NOTE = 'note'
+    # row types the converter processes, rows of other types are skipped
+    ROW_TYPES = (TYPE_TASK, TYPE_NOTE)
+    # encoded row types kept in the outline cache
+    CACHED_ROW_TYPES = (TYPE_TASK.encode('ascii'), TYPE_NOTE.encode('ascii'))
 
     TITLE = re.compile("(?P<title>.*?) \[[0-9]{5,14}\]")
 
-    def __init__(self, cmd_args, source_file, target_name=None):
-        self.Row = namedtuple('Row', ', '.join(FIELDNAMES).lower())
+    Row = Row
+    # instrument.Stats of the conversion, if it's profiled
+    stats = None
+
+    def __init__(self, cmd_args, source_file, target_name=None, target_file=None):
         self.source_file = source_file
+        # binary file-like object written to instead of target_name, it's left open
+        self.target_file = target_file
         self.source_name = cmd_args.file
         if target_name:
             self.target_name = target_name
         else:
             self.target_name = self.make_target_name(self.source_name)
+        # progress.Progress of the conversion, if it runs in the background
+        self.progress = getattr(cmd_args, 'progress', None)
+        outline_cache = getattr(cmd_args, 'outline_cache', None)
+        if outline_cache:
+            self.outline_cache = OutlineCache(
+                outline_cache, getattr(cmd_args, 'outline_cache_size', DEFAULT_OUTLINE_CACHE_SIZE))
+        else:
+            self.outline_cache = None
 
         logger.debug("set target name to '%s'" % self.target_name)
 
@@ -56,21 +121,232 @@ class Converter(object):
 
     def convert(self):
         """
-        Should be overridden in subclasses. Subclasses need to implement
-        process_task(row) and process_note(note).
+        Convert the source file: start(), process all rows, finish().
+
+        Subclasses implement process_task(row) and process_note(note) for the
+        types in ROW_TYPES, and extend start(), finish() and abort() to open,
+        complete and (after an error) close their target.
+        """
+        finish = self.finish
+        if self.stats:
+            finish = self.stats.timed('finish', finish)
+        self.start()
+        try:
+            self.process_rows(self.rows())
+        except BaseException:
+            self.abort()
+            raise
+        finish()
+
+    def start(self):
+        """Prepare the target before the first row."""
+        pass
+
+    def finish(self):
+        """Complete the target after the last row."""
+        pass
+
+    def abort(self):
+        """Clean up when the conversion failed."""
+        pass
+
+    def rows(self):
+        """Iterate over the rows of the source file."""
+        cells = self._parse_source('csv', self._read_cells)
+        if self.stats:
+            cells = self.stats.timed_iter('read', cells, 'rows')
+        if self.progress:
+            cells = self.progress.track(cells)
+        return itertools.imap(self.Row, cells)
+
+    def _read_cells(self):
+        """
+        Cells of the task and note rows of the source, as kept in the outline
+        cache. Empty cells at the end are dropped, Row reads them as ''.
         """
-        for row in map(self.Row._make, UnicodeReader(self.source_file)):
-            if row.type == self.TYPE_TASK:
-                self.process_task(row)
-            elif row.type == self.TYPE_NOTE:
-                note = Note(row.content)
-                self.process_note(note)
+        types = self.CACHED_ROW_TYPES
+        for cells in csv.reader(skip_bom(self._source())):
+            if cells and cells[0] in types:
+                while not cells[-1]:
+                    cells.pop()
+                yield tuple(cells)
+
+    def _source(self):
+        """The source file, counting bytes_in if profiled."""
+        if self.stats:
+            return self.stats.reader(self.source_file)
+        return self.source_file
+
+    def _parse_source(self, kind, parse):
+        """Return parse(), or what it returned for the unchanged source from the outline cache."""
+        if self.outline_cache:
+            return self.outline_cache.get(self.source_file, kind, parse)
+        return parse()
+
+    def process_rows(self, rows):
+        """
+        Hand rows to process_task() and process_note(). Notes are parsed only
+        when the converter reads their text or attachment.
+        """
+        process_task = self.process_task if self.TYPE_TASK in self.ROW_TYPES else None
+        process_note = self.process_note if self.TYPE_NOTE in self.ROW_TYPES else None
+        make_note = Note
+        if self.stats:
+            if process_task:
+                process_task = self.stats.timed('render', process_task, 'tasks')
+            if process_note:
+                process_note = self.stats.timed('render', process_note)
+            make_note = self.stats.parse_note
+        for row in rows:
+            type = row.type
+            if type == self.TYPE_TASK:
+                if process_task:
+                    process_task(row)
+            elif type == self.TYPE_NOTE and process_note:
+                process_note(make_note(row.content))
+
+    def _open_target(self):
+        """Return an OutputSink that appends to the target file."""
+        return OutputSink(self._open_file(self.target_name, 'ab'), close_target=True)
+
+    def _open_file(self, filename, mode):
+        """Open a target file (or use target_file), writes are timed if profiled."""
+        if self.target_file is not None:
+            target = KeepOpen(self.target_file)
+        else:
+            target = open(filename, mode)
+        if self.stats:
+            target = self.stats.writer(target)
+        return target
 
     def _print(self, *msg):
-        print(*msg, file=self.target)
+        self.target.writeline(*msg)
+
+
+class IndentCache(dict):
+    """Indent strings by level, e.g. IndentCache('\t')[2] == '\t\t'."""
+
+    def __init__(self, char):
+        super(IndentCache, self).__init__()
+        self.char = char
+
+    def __missing__(self, level):
+        indent = self[level] = self.char * level
+        return indent
 
 
 class Downloadable(object):
+    """
+    Mixin for converters that can download attachments. Downloads run in
+    the background while the converter continues with the next rows.
+
+    A converter creates its own DownloadScheduler, unless one is assigned
+    to downloader before the conversion starts (see ConverterGroup).
+    """
+    downloader = None
+
     def __init__(self, cmd_args, *args, **kwargs):
         super(Downloadable, self).__init__(cmd_args, *args, **kwargs)
         self.download_attachments = cmd_args.download
+        self.download_threads = getattr(cmd_args, 'download_threads', DEFAULT_DOWNLOAD_THREADS)
+        self.download_buffer = getattr(cmd_args, 'download_buffer', DEFAULT_DOWNLOAD_BUFFER)
+        self.cache_dir = getattr(cmd_args, 'cache', None)
+        self.cache_size = getattr(cmd_args, 'cache_size', DEFAULT_CACHE_SIZE)
+        self.revalidate = getattr(cmd_args, 'revalidate', False)
+        self.owns_downloader = False
+
+    def make_downloader(self):
+        cache = None
+        if self.cache_dir:
+            cache = AttachmentCache(self.cache_dir, self.cache_size, self.revalidate)
+        return DownloadScheduler(self.download_threads, self.download_buffer, cache, self.stats, self.progress)
+
+    def start(self):
+        super(Downloadable, self).start()
+        if self.download_attachments and self.downloader is None:
+            self.downloader = self.make_downloader()
+            self.owns_downloader = True
+
+    def finish(self):
+        super(Downloadable, self).finish()
+        if self.owns_downloader:
+            self.downloader.join()
+
+    def abort(self):
+        super(Downloadable, self).abort()
+        if self.owns_downloader:
+            self.downloader.join(raise_errors=False)
+
+    def download(self, attachment):
+        """Schedule attachment for download and return its relative path."""
+        return self.downloader.schedule(attachment)
+
+
+class ConverterGroup(object):
+    """
+    Convert one CSV source with several converters in a single pass.
+
+    Every row is read and every note is parsed once and handed to all
+    converters, attachments are downloaded once for all converters that
+    download them.
+    """
+
+    def __init__(self, converters, stats=None):
+        self.converters = converters
+        self.stats = stats
+        for converter in converters:
+            converter.stats = stats
+
+    def convert(self):
+        downloading = [c for c in self.converters
+                       if isinstance(c, Downloadable) and c.download_attachments]
+        downloader = None
+        if downloading:
+            downloader = downloading[0].make_downloader()
+            for converter in downloading:
+                converter.downloader = downloader
+        started = []
+        try:
+            for converter in self.converters:
+                converter.start()
+                started.append(converter)
+            self.process_rows(self.converters[0].rows())
+            if downloader:
+                downloader.join()
+        except BaseException:
+            if downloader:
+                downloader.join(raise_errors=False)
+            for converter in started:
+                converter.abort()
+            raise
+        for index, converter in enumerate(self.converters):
+            finish = converter.finish
+            if self.stats:
+                finish = self.stats.timed('finish', finish)
+            try:
+                finish()
+            except BaseException:
+                # the converters after the failed one are still open
+                for converter in self.converters[index + 1:]:
+                    converter.abort()
+                raise
+
+    def process_rows(self, rows):
+        tasks = [c.process_task for c in self.converters if Converter.TYPE_TASK in c.ROW_TYPES]
+        notes = [c.process_note for c in self.converters if Converter.TYPE_NOTE in c.ROW_TYPES]
+        make_note = Note
+        if self.stats:
+            # count every task once, not once per converter
+            tasks = [self.stats.timed('render', process_task, None if i else 'tasks')
+                     for i, process_task in enumerate(tasks)]
+            notes = [self.stats.timed('render', process_note) for process_note in notes]
+            make_note = self.stats.parse_note
+        for row in rows:
+            type = row.type
+            if type == Converter.TYPE_TASK:
+                for process_task in tasks:
+                    process_task(row)
+            elif type == Converter.TYPE_NOTE and notes:
+                note = make_note(row.content)
+                for process_note in notes:
+                    process_note(note)
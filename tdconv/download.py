@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import httplib
+import logging
+import os
+import Queue
+import socket
+import tempfile
+import threading
+import time
+import urllib2
+import urlparse
+
+
+logger = logging.getLogger("tdconv")
+
+DEFAULT_DOWNLOAD_THREADS = 4
+# cap for the memory all download threads of a run use for buffering
+DEFAULT_DOWNLOAD_BUFFER = 1024 * 1024
+MIN_CHUNK_SIZE = 4096
+
+
+def _umask():
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+# mode of downloaded files, like open() would create them (mkstemp makes them private)
+FILE_MODE = 0o666 & ~_umask()
+
+
+class DownloadError(Exception):
+    pass
+
+
+class BufferMeter(object):
+    """Thread-safe accounting of the bytes currently held in download buffers."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.current = 0
+        self.peak = 0
+
+    def acquire(self, size):
+        with self.lock:
+            self.current += size
+            if self.current > self.peak:
+                self.peak = self.current
+
+    def release(self, size):
+        with self.lock:
+            self.current -= size
+
+
+def stream_to_file(source, filename, chunk_size, meter=None, digest=None):
+    """
+    Copy file-like source to filename in chunks of chunk_size bytes, and
+    update digest (a hashlib object) with the data if present.
+
+    Data is written to a temporary file in the same directory, which is
+    renamed to filename when complete, so filename never contains a
+    partial download.
+    """
+    dirname, basename = os.path.split(filename)
+    fd, tmp = tempfile.mkstemp(prefix='.%s.' % basename, suffix='.part', dir=dirname or '.')
+    try:
+        os.chmod(tmp, FILE_MODE)
+        with os.fdopen(fd, 'wb') as target:
+            while True:
+                chunk = source.read(chunk_size)
+                if not chunk:
+                    break
+                size = len(chunk)
+                if meter:
+                    meter.acquire(size)
+                target.write(chunk)
+                if digest:
+                    digest.update(chunk)
+                del chunk
+                if meter:
+                    meter.release(size)
+        os.rename(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
+
+
+class ConnectionPool(object):
+    """
+    Keep-alive HTTP(S) connections, one per host.
+
+    URLs for which a proxy is configured (http_proxy, https_proxy, no_proxy
+    in the environment) and other schemes are opened with urllib2, like
+    they were before there was a pool.
+
+    A pool is not thread-safe, every download thread uses its own pool.
+    """
+    MAX_REDIRECTS = 5
+    REDIRECT_STATUS = (301, 302, 303, 307, 308)
+
+    def __init__(self, timeout=60):
+        self.timeout = timeout
+        self.connections = {}
+        self.proxies = urllib2.getproxies()
+
+    def open(self, url, headers=None):
+        """
+        Request url and return the response, following redirects.
+        A 304 response is returned only if (conditional) headers are given.
+        The response must be read completely before the next call to open().
+        """
+        headers = headers or {}
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            if parts.scheme not in ('http', 'https') or self._proxied(parts):
+                return self._urlopen(url, headers)
+            response = self._request(parts, headers)
+            if response.status in self.REDIRECT_STATUS:
+                location = response.getheader('location')
+                response.read()
+                if not location:
+                    raise DownloadError('redirect without location', url)
+                url = urlparse.urljoin(url, location)
+            elif response.status == 200 or (response.status == 304 and headers):
+                return response
+            else:
+                response.read()
+                raise DownloadError('HTTP %s %s' % (response.status, response.reason), url)
+        raise DownloadError('too many redirects', url)
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+        self.connections.clear()
+
+    def _proxied(self, parts):
+        return parts.scheme in self.proxies and not urllib2.proxy_bypass(parts.hostname or '')
+
+    def _urlopen(self, url, headers):
+        """Open url with urllib2, which follows redirects itself."""
+        try:
+            response = urllib2.urlopen(urllib2.Request(url, headers=headers), timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 304 and headers:
+                e.status = e.code
+                return e
+            raise DownloadError('HTTP %s %s' % (e.code, e.msg), url)
+        response.status = response.getcode() or 200
+        return response
+
+    def _request(self, parts, headers):
+        path = parts.path or '/'
+        if parts.query:
+            path = '?'.join((path, parts.query))
+        path = path.encode('utf-8')
+        key = (parts.scheme, parts.netloc)
+        try:
+            return self._send(key, path, headers)
+        except (httplib.HTTPException, socket.error):
+            # the server may have closed a kept-alive connection, retry once on a new one
+            self._drop(key)
+            return self._send(key, path, headers)
+
+    def _send(self, key, path, headers):
+        connection = self.connections.get(key)
+        if connection is None:
+            scheme, netloc = key
+            if scheme == 'https':
+                connection = httplib.HTTPSConnection(netloc, timeout=self.timeout)
+            else:
+                connection = httplib.HTTPConnection(netloc, timeout=self.timeout)
+            self.connections[key] = connection
+        connection.request('GET', path, headers=headers)
+        return connection.getresponse()
+
+    def _drop(self, key):
+        connection = self.connections.pop(key, None)
+        if connection is not None:
+            connection.close()
+
+
+class DownloadScheduler(object):
+    """
+    Download attachments in a pool of worker threads.
+
+    schedule() reserves a filename for the attachment and returns its
+    relative path right away, the actual download happens in the background.
+    With a cache, a file of an earlier run that has the cached contents is
+    used as it is.
+    join() waits for all downloads and raises the first error (in the order
+    the attachments were scheduled).
+
+    buffer_size caps the memory used for buffering downloads across all
+    threads, peak_buffered reports the actual peak. Every thread buffers
+    at least MIN_CHUNK_SIZE bytes, so a small buffer runs fewer threads. If an AttachmentCache is
+    given, attachments are fetched through the cache. If instrument.Stats
+    are given, downloads are timed and counted. Downloaded bytes are
+    reported to a progress.Progress, once it's cancelled the remaining
+    downloads are skipped.
+    """
+
+    def __init__(self, threads=DEFAULT_DOWNLOAD_THREADS, buffer_size=DEFAULT_DOWNLOAD_BUFFER, cache=None,
+                 stats=None, progress=None):
+        buffer_size = max(1, buffer_size)
+        self.thread_count = max(1, min(threads, buffer_size // MIN_CHUNK_SIZE))
+        self.chunk_size = buffer_size // self.thread_count
+        self.meter = BufferMeter()
+        self.cache = cache
+        self.stats = stats
+        self.progress = progress
+        self.queue = Queue.Queue()
+        self.threads = []
+        self.errors = []
+        self.count = 0
+        self.allocator = None
+        # relative path of every URL scheduled in this run
+        self.relpaths = {}
+
+    def schedule(self, attachment):
+        """
+        Register an attachment for download, return its relative path.
+        An attachment (or URL) that is already scheduled is not downloaded
+        again, all attachments with the same URL share one file.
+        """
+        if attachment.relpath is None:
+            relpath = self.relpaths.get(attachment.url)
+            if relpath is None and self.cache:
+                # an earlier run may have left the attachment in place
+                relpath = self.cache.find(attachment.url, self._get_allocator(attachment).existing(attachment.name))
+                if relpath is not None:
+                    self.relpaths[attachment.url] = relpath
+            if relpath is None:
+                relpath = self.relpaths[attachment.url] = attachment.reserve(self._get_allocator(attachment))
+                if not self.threads:
+                    self._start()
+                self.queue.put((self.count, attachment, relpath))
+                self.count += 1
+            attachment.relpath = relpath
+        return attachment.relpath
+
+    def _get_allocator(self, attachment):
+        if self.allocator is None:
+            self.allocator = attachment.make_allocator()
+        return self.allocator
+
+    @property
+    def peak_buffered(self):
+        return self.meter.peak
+
+    def join(self, raise_errors=True):
+        """Wait for all scheduled downloads to finish."""
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        if self.cache:
+            self.cache.save()
+        if self.errors and raise_errors:
+            self.errors.sort(key=lambda e: e[0])
+            index, attachment, exc = self.errors[0]
+            raise exc
+
+    def _start(self):
+        for i in range(self.thread_count):
+            thread = threading.Thread(target=self._work, name='download-%s' % i)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        pool = ConnectionPool()
+        try:
+            while True:
+                job = self.queue.get()
+                if job is None:
+                    break
+                index, attachment, relpath = job
+                if self.progress and self.progress.cancelled.is_set():
+                    # remove the reserved (empty) file
+                    remove(relpath)
+                    continue
+                logger.debug("downloading '%s' to '%s'" % (attachment.url, relpath))
+                started = time.time()
+                try:
+                    if self.cache:
+                        self.cache.fetch(attachment.url, relpath, pool, self.chunk_size, self.meter)
+                    else:
+                        stream_to_file(pool.open(attachment.url), relpath, self.chunk_size, self.meter)
+                except Exception as e:
+                    self.errors.append((index, attachment, e))
+                    # remove the reserved (empty) file
+                    remove(relpath)
+                else:
+                    if self.stats:
+                        self.stats.add('download', time.time() - started)
+                        self.stats.count('downloads')
+                        self.stats.count('bytes_downloaded', os.path.getsize(relpath))
+                    if self.progress:
+                        self.progress.add_download(os.path.getsize(relpath))
+        finally:
+            pool.close()
+
+
+def remove(filename):
+    """Remove filename if it exists."""
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+import cProfile
+import json
+import os
+import threading
+import time
+
+from note import Note
+
+
+class Stats(object):
+    """
+    Timers and counters for the stages of a conversion, see --profile.
+
+    Stages are
+      read: reading and parsing the source (CSV rows, OPML outlines)
+      notes: parsing notes
+      render: converting tasks and notes (including write)
+      write: writing to the target file
+      download: downloading attachments (summed over all download threads)
+      finish: completing the target, including waiting for downloads
+    Counters are rows, tasks, notes, attachments, downloads, bytes_in,
+    bytes_out and bytes_downloaded.
+
+    Converters only use Stats when one is assigned to their stats
+    attribute, so conversions without --profile aren't slowed down.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.seconds = OrderedDict()
+        self.counters = OrderedDict()
+
+    def add(self, stage, seconds):
+        with self.lock:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, stage, function, counter=None):
+        """Return function, timed as stage and counted as counter."""
+        def timed_function(*args):
+            started = time.time()
+            try:
+                return function(*args)
+            finally:
+                self.add(stage, time.time() - started)
+                if counter:
+                    self.count(counter)
+        return timed_function
+
+    def timed_iter(self, stage, iterable, counter=None):
+        """Iterate over iterable, time taken by the iterator is stage, items are counted as counter."""
+        iterator = iter(iterable)
+        while True:
+            started = time.time()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.add(stage, time.time() - started)
+                return
+            self.add(stage, time.time() - started)
+            if counter:
+                self.count(counter)
+            yield item
+
+    def reader(self, f):
+        """Wrap source file f to count bytes_in."""
+        return CountedReader(f, self)
+
+    def parse_note(self, content):
+        """Return a Note for content, parsed right away in the notes stage."""
+        started = time.time()
+        note = Note(content)
+        attachment = note.attachment
+        self.add('notes', time.time() - started)
+        self.count('notes')
+        if attachment:
+            self.count('attachments')
+        return note
+
+    def writer(self, f):
+        """Wrap target file f to time writes and count bytes_out."""
+        return TimedWriter(f, self)
+
+
+class CountedReader(object):
+    """File wrapper that counts the bytes read (or iterated over) as bytes_in."""
+
+    def __init__(self, source, stats):
+        self.source = source
+        self.stats = stats
+
+    def read(self, *args):
+        data = self.source.read(*args)
+        self.stats.count('bytes_in', len(data))
+        return data
+
+    def __iter__(self):
+        for line in self.source:
+            self.stats.count('bytes_in', len(line))
+            yield line
+
+
+class TimedWriter(object):
+    """File wrapper that adds the time spent in write() to the write stage."""
+
+    def __init__(self, target, stats):
+        self.target = target
+        self.stats = stats
+
+    def write(self, data):
+        started = time.time()
+        self.target.write(data)
+        self.stats.add('write', time.time() - started)
+        self.stats.count('bytes_out', len(data))
+
+    def __getattr__(self, name):
+        return getattr(self.target, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.target.close()
+
+
+class Profile(object):
+    """
+    Collect Stats for every input file of a run and write them as JSON
+    report. With dump_dir, every input is also run under cProfile and the
+    profile is dumped to <dump_dir>/<input name>.prof.
+    """
+
+    def __init__(self, report_file=None, dump_dir=None):
+        self.report_file = report_file
+        self.dump_dir = dump_dir
+        self.inputs = []
+        if dump_dir and not os.path.isdir(dump_dir):
+            os.makedirs(dump_dir)
+
+    def run(self, name, function, *args):
+        """Call function(stats, *args) for input name, profiled with a new Stats."""
+        stats = Stats()
+        started = time.time()
+        try:
+            if self.dump_dir:
+                profiler = cProfile.Profile()
+                try:
+                    profiler.runcall(function, stats, *args)
+                finally:
+                    profiler.dump_stats(self.dump_filename(name))
+            else:
+                function(stats, *args)
+        finally:
+            self.inputs.append(OrderedDict((
+                ('input', name),
+                ('total_seconds', time.time() - started),
+                ('seconds', stats.seconds),
+                ('counters', stats.counters))))
+
+    def dump_filename(self, name):
+        return os.path.join(self.dump_dir, os.path.basename(name) + '.prof')
+
+    def save(self):
+        with open(self.report_file, 'wb') as f:
+            json.dump(OrderedDict((('version', 1), ('inputs', self.inputs))), f, indent=1)
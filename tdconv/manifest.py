@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import json
+import logging
+import os
+import tempfile
+
+
+logger = logging.getLogger("tdconv")
+
+
+class ZipManifest(object):
+    """
+    Record of the zip members converted into a directory.
+
+    For every target file the manifest keeps the name and CRC of the zip
+    member it was converted from, the options that affect the output and the
+    time the conversion took. A member whose CRC (from the zip directory, so
+    the member isn't decompressed) and options match for all its targets,
+    and whose targets still exist, doesn't need to be converted again.
+    """
+    FILENAME = '.tdconv-manifest.json'
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.filename = os.path.join(directory, self.FILENAME)
+        self.entries = self._load()
+
+    def is_current(self, info, targets, options):
+        """Return True if all targets were converted from the same member contents with the same options."""
+        for target in targets:
+            entry = self.entries.get(_key(target))
+            if (not entry or entry['member'] != _text(info.filename) or entry['crc'] != info.CRC
+                    or entry['options'] != options or not os.path.exists(target)):
+                return False
+        return True
+
+    def seconds(self, targets):
+        """Return the time it took to convert targets."""
+        return sum(self.entries[_key(target)]['seconds'] for target in targets)
+
+    def record(self, info, targets, options, seconds):
+        """Record that targets were converted from member info in seconds."""
+        for target in targets:
+            self.entries[_key(target)] = dict(
+                member=_text(info.filename), crc=info.CRC, options=options, seconds=seconds / len(targets))
+
+    def save(self):
+        fd, tmp = tempfile.mkstemp(suffix='.part', dir=self.directory or '.')
+        with os.fdopen(fd, 'wb') as f:
+            json.dump(dict(version=1, targets=self.entries), f, indent=1, sort_keys=True)
+        os.rename(tmp, self.filename)
+
+    def _load(self):
+        try:
+            with open(self.filename, 'rb') as f:
+                return json.load(f)['targets']
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        except (ValueError, KeyError):
+            logger.warning("ignoring corrupt manifest '%s'" % self.filename)
+        return {}
+
+
+def _text(name):
+    """Names as they are stored in the (JSON) manifest."""
+    if isinstance(name, bytes):
+        return name.decode('latin-1')
+    return name
+
+
+def _key(target):
+    return _text(os.path.basename(target))
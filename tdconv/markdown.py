@@ -3,39 +3,47 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import codecs
 from string import Template
 
-from common import Converter, Downloadable
+from common import Converter, Downloadable, IndentCache
 
 
 class CsvToMarkdownConverter(Downloadable, Converter):
     """Convert CSV to Markdown."""
 
-    ATTACHMENT_LINK = Template('[$name]($url)')
-    IMAGE_LINK = Template('![$name]($url)')
-    IMAGE_EXT = ['.jpg', '.jpeg', '.png', '.gif']
+    IMAGE_EXT = ('.jpg', '.jpeg', '.png', '.gif')
+    HEADINGS = IndentCache('#')
     TITLE = Template('# $title\n')
     EXT = 'md'
 
-    def convert(self):
-        with codecs.open(self.target_name, 'a+', 'utf-8') as self.target:
-            self._print(self.TITLE.substitute(title=self.title(self.source_name)))
-            super(CsvToMarkdownConverter, self).convert()
+    def start(self):
+        super(CsvToMarkdownConverter, self).start()
+        self.target = self._open_target()
+        self._print(self.TITLE.substitute(title=self.title(self.source_name)))
+
+    def finish(self):
+        try:
+            super(CsvToMarkdownConverter, self).finish()
             self._print('\n')
+        finally:
+            self.target.close()
+
+    def abort(self):
+        super(CsvToMarkdownConverter, self).abort()
+        self.target.close()
 
     def process_task(self, row):
-        self._print('#' * (int(row.indent) + 1), row.content, '\n')
+        self.target.write(''.join((self.HEADINGS[int(row.indent) + 1], ' ', row.content, ' \n\n')))
 
     def process_note(self, note):
         if note.text:
-            self._print(note.text, '\n')
+            self.target.write(''.join((note.text, ' \n\n')))
         self._process_note_attachment(note.attachment)
 
     def _process_note_attachment(self, attachment):
         if attachment:
             if self.download_attachments:
-                url = attachment.download()
+                url = self.download(attachment)
             else:
                 url = attachment.url
             self._attachment_reference(attachment.name, url)
@@ -45,9 +53,8 @@ class CsvToMarkdownConverter(Downloadable, Converter):
         Determine if attachment is an image, if so, create image reference,
         otherwise create a link.
         """
-        tpl = self.ATTACHMENT_LINK
-        for ext in self.IMAGE_EXT:
-            if url.lower().endswith(ext):
-                tpl = self.IMAGE_LINK
-        url = url.replace(' ', '%20')
-        self._print(tpl.substitute(name=name, url=url), '\n')
+        if url.lower().endswith(self.IMAGE_EXT):
+            start = '!['
+        else:
+            start = '['
+        self.target.write(''.join((start, name, '](', url.replace(' ', '%20'), ') \n\n')))
@@ -3,72 +3,245 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
+from collections import OrderedDict
+import errno
+import hashlib
 import json
 import os.path
 import re
 from string import Template
+import threading
 import urllib2
 
+from download import stream_to_file
+
+
+class ParsedNotes(object):
+    """
+    Parsed notes by the sha1 digest of their content, so the cache doesn't
+    hold the (possibly long) contents. When the cached values grow beyond
+    max_size characters, the least recently used are evicted.
+    """
+    MAX_SIZE = 4 * 1024 * 1024
+
+    def __init__(self, max_size=MAX_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(content):
+        return hashlib.sha1(content.encode('utf-8')).digest()
+
+    def get(self, key):
+        with self.lock:
+            parsed = self.entries.pop(key, None)
+            if parsed is not None:
+                self.entries[key] = parsed
+            return parsed
+
+    def put(self, key, parsed):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = parsed
+            self.size += self._size(parsed)
+            while self.size > self.max_size:
+                key, parsed = self.entries.popitem(last=False)
+                self.size -= self._size(parsed)
+
+    @staticmethod
+    def _size(parsed):
+        return sum(len(value) for value in parsed)
+
 
 class Note(object):
     """
     A note may contain content, or an attachment, or both.
     The attachment is either None, or an Attachment object.
+
+    Content is parsed when text or attachment are first accessed.
     """
-    # pattern for attachments in notes
+    ATTACHMENT_START = '[[file'
+    ATTACHMENT_END = ']]'
+    # pattern for attachments in notes, for notes the scanner can't handle
     NOTE = re.compile("(?P<text>.*?)\[\[file(?P<attachment>.*?)\]\]")
+    JSON = json.JSONDecoder()
+    WHITESPACE = ' \t\r\n'
+
+    # parsed notes with attachments: content -> (text, file_name, file_url)
+    cache = ParsedNotes()
 
     def __init__(self, content):
-        self.text = content
-        self.attachment = None
-        self._extract_content_and_attachment()
+        self.content = content
+        self._parsed = False
+
+    @property
+    def text(self):
+        if not self._parsed:
+            self._extract_content_and_attachment()
+        return self._text
+
+    @property
+    def attachment(self):
+        if not self._parsed:
+            self._extract_content_and_attachment()
+        return self._attachment
 
     def _extract_content_and_attachment(self):
         """Extract note text and attachment (if present)."""
-        match = Note.NOTE.match(self.text)
+        content = self._text = self.content
+        self._attachment = None
+        self._parsed = True
+        if Note.ATTACHMENT_START not in content:
+            return
+        key = Note.cache.key(content)
+        parsed = Note.cache.get(key)
+        if parsed is None:
+            parsed = self._scan(content) or self._match(content)
+            if parsed is None:
+                return
+            Note.cache.put(key, parsed)
+        self._text, name, url = parsed
+        self._attachment = Attachment(name, url=url)
+
+    @staticmethod
+    def _scan(content):
+        """
+        Parse '<text>[[file <json>]]' by decoding the JSON object right after
+        the marker, return None for anything else (including text or JSON
+        that spans several lines, which the pattern does not match either).
+        """
+        start = content.find(Note.ATTACHMENT_START)
+        index = start + len(Note.ATTACHMENT_START)
+        while index < len(content) and content[index] in Note.WHITESPACE:
+            index += 1
+        try:
+            j, index = Note.JSON.raw_decode(content, index)
+        except ValueError:
+            return None
+        while index < len(content) and content[index] in Note.WHITESPACE:
+            index += 1
+        if not content.startswith(Note.ATTACHMENT_END, index) or not isinstance(j, dict):
+            return None
+        if '\n' in content[:index]:
+            return None
+        return content[:start].strip(), j['file_name'], j['file_url']
+
+    @staticmethod
+    def _match(content):
+        match = Note.NOTE.match(content)
         if match:
             j = json.loads(match.group('attachment'))
-            self.text = match.group('text').strip()
-            self.attachment = Attachment(j['file_name'], url=j['file_url'])
+            return match.group('text').strip(), j['file_name'], j['file_url']
+        return None
 
 
 class Attachment(object):
     ATTACHMENTS_DIR = 'attachments'
+    CHUNK_SIZE = 64 * 1024
 
     def __init__(self, filename, url):
         self.name = filename
         self.url = url
+        # path in the attachments dir, once the download is scheduled
+        self.relpath = None
 
     def download(self):
         """Download attachment to attachments dir, make sure dir is created
         and handle filename collisions."""
-        dirname = Attachment.ATTACHMENTS_DIR
-        self._create_attachments_dir(dirname)
-        relpath = self._find_filename(dirname)
+        relpath = self.reserve()
         self._download_file(relpath)
         return relpath
 
-    def _create_attachments_dir(self, dirname):
-        """Create directory if it does not exist, if it exists make sure it's a directory and not a file."""
-        if not(os.path.exists(dirname)):
-            os.mkdir(dirname)
-        if os.path.isfile(dirname):
-            raise Exception(dirname, 'already exist as a file')
+    @classmethod
+    def make_allocator(cls):
+        """Return a FilenameAllocator for the attachments dir."""
+        return FilenameAllocator(cls.ATTACHMENTS_DIR)
+
+    def reserve(self, allocator=None):
+        """Claim a free filename in the attachments dir by creating an empty file,
+        so the name is taken until the attachment is downloaded. Pass an
+        allocator to reserve several attachments without rescanning the dir."""
+        if allocator is None:
+            allocator = self.make_allocator()
+        return allocator.allocate(self.name)
 
     def _download_file(self, filename):
         """Download a URL to filename."""
-        f = urllib2.urlopen(self.url)
-        with open(filename, "wb") as target:
-            target.write(f.read())
-
-    def _find_filename(self, dirname):
-        """Indentify (and return) a filename for the attachment: if filename is already taken,
-        try <filename>(n>1).<ext> until file can be downloaded."""
-        full_filename = os.path.join(dirname, self.name)
-        root, ext = os.path.splitext(self.name)
-        index = 1
-        tpl = Template("$root($index)$ext")
-        while os.path.exists(full_filename):
-            index += 1
-            full_filename = os.path.join(dirname, tpl.substitute(root=root, index=index, ext=ext))
-        return full_filename
+        stream_to_file(urllib2.urlopen(self.url), filename, Attachment.CHUNK_SIZE)
+
+
+class FilenameAllocator(object):
+    """
+    Allocate unique filenames in a directory: if filename is already taken,
+    try <filename>(n>1).<ext>.
+
+    The directory is listed once, later allocations are looked up in memory.
+    Every name is claimed by creating the file with O_EXCL, so allocators in
+    other threads or processes can never hand out the same name.
+    """
+    NAME = Template("$root($index)$ext")
+    INDEXED = re.compile(r'^(.*)\((\d+)\)$', re.DOTALL)
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self._create_dir()
+        self.lock = threading.Lock()
+        self.taken = set(os.listdir(dirname))
+        # next index to try for each filename, all lower indexes are taken
+        self.next_index = {}
+        # names that were in the directory before, by the filename they were allocated for
+        self.listed = {}
+        for name in self.taken:
+            root, ext = os.path.splitext(name)
+            match = self.INDEXED.match(root)
+            self.listed.setdefault(match.group(1) + ext if match else name, []).append(name)
+
+    def existing(self, filename):
+        """Return the paths of filename and <filename>(n).<ext> that were in the directory when it was listed."""
+        return [os.path.join(self.dirname, name) for name in sorted(self.listed.get(filename, ()), key=self._index)]
+
+    def _index(self, name):
+        match = self.INDEXED.match(os.path.splitext(name)[0])
+        return int(match.group(2)) if match else 1
+
+    def allocate(self, filename):
+        """Claim and return a path for filename."""
+        root, ext = os.path.splitext(filename)
+        with self.lock:
+            index = self.next_index.get(filename, 1)
+            while True:
+                if index == 1:
+                    name = filename
+                else:
+                    name = self.NAME.substitute(root=root, index=index, ext=ext)
+                index += 1
+                if name not in self.taken:
+                    self.taken.add(name)
+                    path = os.path.join(self.dirname, name)
+                    if self._claim(path):
+                        self.next_index[filename] = index
+                        return path
+
+    def _claim(self, path):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666)
+        except OSError as e:
+            if e.errno == errno.EEXIST:
+                return False
+            raise
+        os.close(fd)
+        return True
+
+    def _create_dir(self):
+        """Create directory if it does not exist, if it exists make sure it's a directory and not a file."""
+        if not(os.path.exists(self.dirname)):
+            try:
+                os.mkdir(self.dirname)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        if os.path.isfile(self.dirname):
+            raise Exception(self.dirname, 'already exist as a file')
@@ -3,7 +3,7 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import codecs
+import os
 from string import Template
 from unicode_csv import UnicodeWriter
 import xml.etree.cElementTree as ET
@@ -25,26 +25,36 @@ class CsvToOpmlConverter(OpmlConverter):
     def __init__(self, cmd_args, *args, **kwargs):
         super(CsvToOpmlConverter, self).__init__(cmd_args, *args, **kwargs)
 
-    def convert(self):
-        opml, self.parents = self._prepare_document()
-        super(CsvToOpmlConverter, self).convert()
-        tree = ET.ElementTree(opml)
-        tree.write(self.target_name, encoding='UTF-8', xml_declaration=True)
-
-    def _prepare_document(self):
-        opml = ET.Element("opml", version='1.0')
-        head = ET.SubElement(opml, 'head')
-        ET.SubElement(head, 'title').text = self.title(self.source_name)
-        ET.SubElement(head, 'expansionState').text = '0,1'
-        body = ET.SubElement(opml, 'body')
-        parents = {}
-        parents[0] = body
-        return opml, parents
+    def start(self):
+        super(CsvToOpmlConverter, self).start()
+        self.notes = []
+        # the document is written to a temporary file that replaces the
+        # target once it's complete, a failed conversion leaves no partial .opml
+        self.partial_name = None if self.target_file is not None else self.target_name + '.part'
+        self.target = self._open_file(self.partial_name, 'wb')
+        self.writer = OpmlWriter(self.target, self.title(self.source_name))
+
+    def finish(self):
+        try:
+            super(CsvToOpmlConverter, self).finish()
+            self._finish_outline()
+            self.writer.close()
+        except BaseException:
+            self.target.close()
+            self._remove_partial()
+            raise
+        self.target.close()
+        if self.partial_name:
+            os.rename(self.partial_name, self.target_name)
+
+    def abort(self):
+        super(CsvToOpmlConverter, self).abort()
+        self.target.close()
+        self._remove_partial()
 
     def process_task(self, row):
-        level = int(row.indent)
-        self.current = ET.SubElement(self.parents[level - 1], 'outline', text=row.content)
-        self.parents[level] = self.current
+        self._finish_outline()
+        self.current = self.writer.start_outline(int(row.indent), row.content)
 
     def process_note(self, note):
         if note.text:
@@ -53,11 +63,100 @@ class CsvToOpmlConverter(OpmlConverter):
             self._opml_append_note(self.OPML_IMAGE.substitute(name=note.attachment.name, url=note.attachment.url))
 
     def _opml_append_note(self, contents):
-        note = self.current.get(self.NOTE_ATTRIB)
-        if note:
-            self.current.set(self.NOTE_ATTRIB, '\n\n'.join((note, contents)))
+        self.notes.append(contents)
+
+    def _remove_partial(self):
+        if self.partial_name:
+            try:
+                os.remove(self.partial_name)
+            except OSError:
+                pass
+
+    def _finish_outline(self):
+        """Join all notes of the current outline into its note attribute."""
+        if self.notes:
+            self.current[self.NOTE_ATTRIB] = '\n\n'.join(self.notes)
+            self.notes = []
+
+
+class OpmlWriter(object):
+    """
+    Write an OPML document outline by outline, with the same output as
+    ElementTree.write(encoding='UTF-8', xml_declaration=True) would produce
+    for the complete tree.
+
+    An outline is written when the next one starts (or the document is
+    closed), because only then it's clear if it has children. Memory holds
+    the attributes of that outline and the levels of its open ancestors.
+    """
+    ENCODING = 'UTF-8'
+
+    def __init__(self, target, title):
+        self.target = target
+        self.open_levels = []
+        self.pending = None
+        self.empty_body = True
+        self.target.write(b"<?xml version='1.0' encoding='UTF-8'?>\n")
+        self.target.write(b'<opml version="1.0"><head>')
+        self._write_element('title', title)
+        self._write_element('expansionState', '0,1')
+        self.target.write(b'</head><body')
+
+    def start_outline(self, level, text):
+        """
+        Start an outline at level (1 is top level) and return its attributes,
+        which may be changed until the next outline starts.
+        """
+        self._write_pending(level)
+        if self.empty_body:
+            self.target.write(b'>')
+            self.empty_body = False
+        self.pending = level, {'text': text}
+        return self.pending[1]
+
+    def close(self):
+        """Write all open outlines and finish the document."""
+        self._write_pending(None)
+        if self.empty_body:
+            self.target.write(b' /></opml>')
         else:
-            self.current.set(self.NOTE_ATTRIB, contents)
+            self.target.write(b'</body></opml>')
+
+    def _write_pending(self, next_level):
+        """Write pending outline and close all outlines at or below next_level."""
+        write = self.target.write
+        if self.pending:
+            level, attributes = self.pending
+            write(b'<outline')
+            for name, value in sorted(attributes.items()):
+                write(b' %s="%s"' % (name.encode(self.ENCODING), escape_attribute(value, self.ENCODING)))
+            if next_level is not None and next_level > level:
+                write(b'>')
+                self.open_levels.append(level)
+            else:
+                write(b' />')
+            self.pending = None
+        while self.open_levels and (next_level is None or self.open_levels[-1] >= next_level):
+            self.open_levels.pop()
+            write(b'</outline>')
+
+    def _write_element(self, tag, text):
+        tag = tag.encode(self.ENCODING)
+        if text:
+            self.target.write(b'<%s>%s</%s>' % (tag, escape_text(text, self.ENCODING), tag))
+        else:
+            self.target.write(b'<%s />' % tag)
+
+
+def escape_text(text, encoding):
+    """Escape and encode character data like ElementTree does."""
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').encode(encoding, 'xmlcharrefreplace')
+
+
+def escape_attribute(text, encoding):
+    """Escape and encode an attribute value like ElementTree does."""
+    text = text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+    return text.replace('"', '&quot;').replace('\n', '&#10;').encode(encoding, 'xmlcharrefreplace')
 
 
 class OpmlToCsvConverter(OpmlConverter):
@@ -68,17 +167,48 @@ class OpmlToCsvConverter(OpmlConverter):
         super(OpmlToCsvConverter, self).__init__(cmd_args, *args, **kwargs)
 
     def convert(self):
-        document_body = self._prepare_document()
-        with codecs.open(self.target_name, 'w+') as target:
+        with self._open_file(self.target_name, 'w+') as target:
             self.writer = UnicodeWriter(target, FIELDNAMES)
             self._write_header_row()
-            for outline in document_body:
-                self.process_element(outline)
-
-    def _prepare_document(self):
-        tree = ET.parse(self.source_file)
-        opml = tree.getroot()
-        return opml.find('body')
+            outlines = self._parse_source('opml', self._read_outlines)
+            process_outline = self.process_outline
+            if self.stats:
+                outlines = self.stats.timed_iter('read', outlines, 'rows')
+                process_outline = self.stats.timed('render', process_outline, 'tasks')
+            if self.progress:
+                outlines = self.progress.track(outlines)
+            for level, text, note in outlines:
+                process_outline(level, text, note)
+            self.writer.flush()
+
+    def _read_outlines(self):
+        """
+        Walk the document with iterparse and yield (level, text, note) for
+        every outline in the body as soon as it starts. Finished outlines are
+        removed from the tree, so memory depends on the nesting depth, not on
+        the size of the document.
+        """
+        # open elements within the body, with a flag if they are processed outlines
+        stack = []
+        in_body = False
+        for event, element in ET.iterparse(self._source(), events=(b'start', b'end')):
+            if not in_body:
+                if element.tag == 'body' and event == 'start':
+                    in_body = True
+                    stack.append((element, True))
+                continue
+            if event == 'start':
+                process = element.tag == 'outline' and stack[-1][1]
+                if process:
+                    yield len(stack), element.get('text'), element.get(self.NOTE_ATTRIB)
+                stack.append((element, process))
+            else:
+                stack.pop()
+                if not stack:
+                    # end of body
+                    break
+                element.clear()
+                stack[-1][0].remove(element)
 
     def _write_header_row(self):
         self.writer.writerow(FIELDNAMES)
@@ -86,16 +216,12 @@ class OpmlToCsvConverter(OpmlConverter):
     def _make_row(self, type='', content='', indent=''):
         return [type, content, '', indent, '', '', '', '', '']
 
-    def process_element(self, outline, level=1):
+    def process_outline(self, level, text, note):
         # content
-        row = self._make_row(self.TYPE_TASK, outline.get('text'), str(level))
-        self.writer.writerow(row)
+        rows = [self._make_row(self.TYPE_TASK, text, str(level))]
         # note
-        note = outline.get(self.NOTE_ATTRIB)
         if note:
-            row = self._make_row(self.TYPE_NOTE, note)
-            self.writer.writerow(row)
+            rows.append(self._make_row(self.TYPE_NOTE, note))
         # separator
-        self.writer.writerow(self._make_row())
-        for subelement in outline.findall('outline'):
-            self.process_element(subelement, level + 1)
+        rows.append(self._make_row())
+        self.writer.writerows(rows)
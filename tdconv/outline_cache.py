@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import errno
+import hashlib
+import logging
+import marshal
+import os
+import stat
+import sys
+import tempfile
+
+
+logger = logging.getLogger("tdconv")
+
+DEFAULT_OUTLINE_CACHE_SIZE = 256 * 1024 * 1024
+
+
+class OutlineCache(object):
+    """
+    Persistent cache for the parsed contents of source files.
+
+    Converters keep the stream of tasks and notes they parse from a source
+    (e.g. the cells of the task and note rows of a CSV file) and replay it as
+    long as the source is unchanged, i.e. has the same path, size, mtime and
+    SHA-1 of its contents. Only regular files are cached, zip members are
+    always parsed.
+
+    Every source is stored in its own file, so several processes may share a
+    cache directory: a marshal record with the signature, followed by
+    records of up to CHUNK_ITEMS items and None at the end. Items are stored
+    while they are parsed and replayed chunk by chunk, neither holds more
+    than a chunk in memory. When the cache grows beyond max_size, least
+    recently used files are evicted.
+    """
+    FORMAT = 2
+    CHUNK_ITEMS = 1024
+    HASH_CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, directory, max_size=DEFAULT_OUTLINE_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, source_file, kind, parse):
+        """
+        Return the parsed stream of source_file: from the cache if the source
+        is unchanged, otherwise from parse(), which must return an iterable of
+        marshallable items and is stored for the next run (once it's consumed
+        completely). kind names the parser (and the format of its items).
+        """
+        info = regular_file_stat(source_file)
+        if info is None:
+            return parse()
+        path = os.path.abspath(source_file.name)
+        digest = file_hash(path, self.HASH_CHUNK_SIZE)
+        path = unicode_path(path)
+        signature = (path, info.st_size, info.st_mtime, digest)
+        filename = self._filename(path, kind)
+        f = self._open(filename, signature)
+        if f is not None:
+            self.hits += 1
+            return self._replay(f)
+        self.misses += 1
+        return self._store(filename, signature, parse())
+
+    def invalidate(self, path=None, kinds=('csv', 'opml')):
+        """Remove the entries for path, or all entries if path is None."""
+        if path is None:
+            names = [name for name in os.listdir(self.directory) if not name.endswith('.part')]
+        else:
+            path = unicode_path(os.path.abspath(path))
+            names = [os.path.basename(self._filename(path, kind)) for kind in kinds]
+        for name in names:
+            remove(os.path.join(self.directory, name))
+
+    def _filename(self, path, kind):
+        key = '\0'.join((kind, path)).encode('utf-8')
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def _open(self, filename, signature):
+        """Return filename opened after its signature if it's the cache file of signature, else None."""
+        try:
+            f = open(filename, 'rb')
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        try:
+            version, cached_signature = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            logger.warning("ignoring corrupt outline cache file '%s'" % filename)
+            f.close()
+            return None
+        if version != self.FORMAT or tuple(cached_signature) != signature:
+            f.close()
+            return None
+        # mark as recently used
+        os.utime(filename, None)
+        return f
+
+    def _replay(self, f):
+        """Yield the items of the cache file f, one chunk after the other."""
+        try:
+            while True:
+                try:
+                    chunk = marshal.load(f)
+                except (EOFError, ValueError, TypeError):
+                    raise ValueError("outline cache file '%s' is truncated, clear the cache" % f.name)
+                if chunk is None:
+                    break
+                for item in chunk:
+                    yield item
+        finally:
+            f.close()
+
+    def _store(self, filename, signature, items):
+        """Yield items and write them to filename, which is replaced once all items are written."""
+        fd, tmp = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            marshal.dump((self.FORMAT, signature), f, 2)
+            chunk = []
+            for item in items:
+                chunk.append(item)
+                if len(chunk) == self.CHUNK_ITEMS:
+                    marshal.dump(chunk, f, 2)
+                    chunk = []
+                yield item
+            if chunk:
+                marshal.dump(chunk, f, 2)
+            marshal.dump(None, f, 2)
+            f.close()
+            os.rename(tmp, filename)
+        except BaseException:
+            # also when the items aren't consumed completely (GeneratorExit)
+            f.close()
+            remove(tmp)
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.part'):
+                continue
+            filename = os.path.join(self.directory, name)
+            try:
+                info = os.stat(filename)
+            except OSError:
+                continue
+            entries.append((info.st_mtime, info.st_size, filename))
+        total = sum(size for mtime, size, filename in entries)
+        for mtime, size, filename in sorted(entries):
+            if total <= self.max_size:
+                break
+            remove(filename)
+            total -= size
+
+
+def regular_file_stat(f):
+    """Return os.fstat() of file object f if it is a regular file, else None."""
+    try:
+        info = os.fstat(f.fileno())
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
+    if stat.S_ISREG(info.st_mode) and getattr(f, 'name', None):
+        return info
+    return None
+
+
+def unicode_path(path):
+    if isinstance(path, bytes):
+        return path.decode(sys.getfilesystemencoding() or 'utf-8', 'replace')
+    return path
+
+
+def file_hash(path, chunk_size):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def remove(filename):
+    try:
+        os.remove(filename)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import threading
+import time
+
+
+class ConversionCancelled(Exception):
+    """The conversion was cancelled with Progress.cancel()."""
+
+
+class Progress(object):
+    """
+    Progress of a conversion that runs in another thread, and cooperative
+    cancellation.
+
+    Converters report files, rows and downloaded bytes, and call
+    checkpoint() regularly, which raises ConversionCancelled once cancel()
+    has been called. callback(progress) is called from the converting
+    thread when a file is done, and otherwise at most every interval
+    seconds.
+
+    A Progress is passed to convert() as args.progress. It isn't handed
+    to worker processes, so rows and downloads of zip members converted
+    with --jobs aren't counted, only the members.
+    """
+    # rows between two checkpoints
+    ROWS = 1000
+
+    def __init__(self, callback=None, interval=0.5):
+        self.callback = callback
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.cancelled = threading.Event()
+        self.files_total = 0
+        self.files_done = 0
+        self.rows = 0
+        self.bytes_downloaded = 0
+        self.last_report = 0
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def checkpoint(self):
+        """Raise ConversionCancelled if the conversion was cancelled."""
+        if self.cancelled.is_set():
+            raise ConversionCancelled()
+
+    def add_files(self, count):
+        with self.lock:
+            self.files_total += count
+
+    def file_done(self):
+        with self.lock:
+            self.files_done += 1
+        self.report(force=True)
+
+    def add_rows(self, count):
+        with self.lock:
+            self.rows += count
+        self.report()
+
+    def add_download(self, size):
+        with self.lock:
+            self.bytes_downloaded += size
+        self.report()
+
+    def track(self, rows):
+        """Iterate over rows, counting them and with a checkpoint every ROWS rows."""
+        count = 0
+        for row in rows:
+            count += 1
+            if count == self.ROWS:
+                self.add_rows(count)
+                self.checkpoint()
+                count = 0
+            yield row
+        self.add_rows(count)
+
+    def report(self, force=False):
+        if not self.callback:
+            return
+        now = time.time()
+        if force or now - self.last_report >= self.interval:
+            self.last_report = now
+            self.callback(self)
+
+    def __str__(self):
+        return '%s/%s files, %s rows, %.1f MB downloaded' % (
+            self.files_done, self.files_total, self.rows, self.bytes_downloaded / 1024.0 / 1024.0)
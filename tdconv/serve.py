@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from argparse import Namespace
+import errno
+import json
+import logging
+import os
+import SocketServer
+import sys
+import time
+import traceback
+
+from tdconv import args_error, convert, make_parser
+
+
+logger = logging.getLogger("tdconv")
+
+
+class ConversionServer(object):
+    """
+    Convert files for requests in a long-running process, so interpreter
+    start and imports are paid once and not for every file.
+
+    The protocol is JSON lines, one request per line
+
+      {"id": 1, "file": "/path/to/Project.csv", "cwd": "/path/to", "options": {"format": "taskpaper"}}
+
+    and one response per request, in the same order
+
+      {"id": 1, "file": "/path/to/Project.csv", "ok": true, "seconds": 0.02}
+      {"id": 1, "file": "/path/to/Project.csv", "ok": false, "error": "...", "traceback": "..."}
+
+    id is returned as it is. cwd is the working directory of the
+    conversion (default: the working directory of the server), options are
+    the command line options by their long name (with _ instead of -),
+    options that are left out have their default value. Instead of file and
+    options, a request may have the command line of tdconv (options and
+    files) in argv, e.g. "argv": ["-f", "taskpaper", "a.csv", "b.csv"],
+    which is answered with one response per file (see tdconv submit).
+    Options are validated like on the command line.
+
+    Requests are converted one after the other, which is what makes
+    changing into cwd safe.
+    """
+
+    def __init__(self):
+        parser = make_parser()
+        self.defaults = vars(parser.parse_args([]))
+        self.actions = dict((action.dest, action) for action in parser._actions)
+
+    def handle(self, line):
+        """Convert the request in line, return its responses (one per file)."""
+        try:
+            request = json.loads(line)
+            if not isinstance(request, dict) or ('file' not in request and 'argv' not in request):
+                raise ValueError("request needs a 'file' or 'argv'")
+        except ValueError as e:
+            return [dict(id=None, ok=False, error='invalid request: %s' % e)]
+        if 'argv' not in request:
+            return [self.convert(request)]
+        try:
+            conversions = self.parse_argv(request['argv'])
+        except ValueError as e:
+            return [dict(id=request.get('id'), ok=False, error='invalid arguments: %s' % e)]
+        return [self.convert(request, args) for args in conversions]
+
+    def convert(self, request, args=None):
+        """Convert args (default: the file and options of request), return the response."""
+        response = dict(id=request.get('id'), file=args.file if args else request['file'])
+        started = time.time()
+        try:
+            if args is None:
+                args = self.make_args(request)
+            cwd = os.getcwd()
+            os.chdir(request.get('cwd') or cwd)
+            try:
+                convert(args)
+            finally:
+                os.chdir(cwd)
+        except Exception as e:
+            tb = traceback.format_exc()
+            logger.error("error converting '%s':\n%s" % (response['file'], tb))
+            response.update(ok=False, error='%s: %s' % (type(e).__name__, e), traceback=tb)
+        else:
+            response.update(ok=True)
+        response['seconds'] = time.time() - started
+        return response
+
+    def make_args(self, request):
+        """Args for the file and options of request, raise ValueError for invalid options."""
+        options = request.get('options') or {}
+        if not isinstance(options, dict):
+            raise ValueError('options must be an object')
+        unknown = sorted(set(options) - set(self.defaults))
+        if unknown:
+            raise ValueError('unknown option(s): %s' % ', '.join(unknown))
+        args = Namespace(**self.defaults)
+        for name, value in options.items():
+            if not valid_option(self.actions[name], value):
+                raise ValueError('invalid value for option %s: %r' % (name, value))
+            setattr(args, name, value)
+        args.file = request['file']
+        error = args_error(args)
+        if error:
+            raise ValueError(error)
+        return args
+
+    def parse_argv(self, argv):
+        """Args for every file of the tdconv command line argv, raise ValueError for invalid arguments."""
+        if not isinstance(argv, list) or not all(isinstance(arg, basestring) for arg in argv):
+            raise ValueError('argv must be a list of strings')
+        parser = make_parser(prog='tdconv submit', parser_class=RequestParser)
+        parser.add_argument('files', nargs='+', metavar='file')
+        args = parser.parse_args(argv)
+        error = args_error(args)
+        if error:
+            raise ValueError(error)
+        files = args.files
+        del args.files
+        return [Namespace(**dict(vars(args), file=filename)) for filename in files]
+
+    def serve(self, requests, responses):
+        """Answer every line of requests with a line on responses."""
+        for line in iter(requests.readline, b''):
+            if not line.strip():
+                continue
+            for response in self.handle(line):
+                responses.write(json.dumps(response).encode('utf-8') + b'\n')
+            responses.flush()
+
+    def serve_stdio(self):
+        """Serve requests on stdin until it's closed."""
+        responses = sys.stdout
+        # converters print, which mustn't end up between the responses
+        sys.stdout = sys.stderr
+        try:
+            self.serve(sys.stdin, responses)
+        finally:
+            sys.stdout = responses
+
+    def make_socket_server(self, path):
+        """Return a SocketServer that serves requests on the UNIX socket path."""
+        server = self
+
+        class RequestHandler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                server.serve(self.rfile, self.wfile)
+
+        remove_socket(path)
+        return SocketServer.UnixStreamServer(path, RequestHandler)
+
+    def serve_socket(self, path):
+        """Serve requests on the UNIX socket path until interrupted."""
+        socket_server = self.make_socket_server(path)
+        logger.info("serving on '%s'" % path)
+        try:
+            socket_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            socket_server.server_close()
+            remove_socket(path)
+
+
+def remove_socket(path):
+    try:
+        os.remove(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
+
+
+class RequestParser(argparse.ArgumentParser):
+    """Parser for the command line of a request, which raises ValueError instead of exiting."""
+
+    def error(self, message):
+        raise ValueError(message)
+
+    def exit(self, status=0, message=None):
+        raise ValueError(message or 'exit %s' % status)
+
+
+def valid_option(action, value):
+    """Whether value (decoded from JSON) is valid for the option of the parser action."""
+    if value is None:
+        return action.default is None
+    if isinstance(action.default, bool):
+        return isinstance(value, bool)
+    if action.type is int or isinstance(action.default, int):
+        return isinstance(value, (int, long)) and not isinstance(value, bool)
+    return isinstance(value, basestring)
+
+
+def main(argv):
+    """tdconv serve [--socket PATH], see client for tdconv submit."""
+    parser = argparse.ArgumentParser(
+        prog='tdconv serve',
+        description='Keep converting files for requests (JSON lines) on stdin or on a UNIX socket, '
+                    'see tdconv submit.')
+    parser.add_argument('--socket', default=None, metavar='PATH',
+                        help='listen on UNIX socket PATH instead of stdin/stdout')
+    args = parser.parse_args(argv)
+    # the log goes to stderr, stdout may carry the responses
+    logging.basicConfig(format='%(message)s', level=logging.INFO)
+    server = ConversionServer()
+    if args.socket:
+        server.serve_socket(args.socket)
+    else:
+        server.serve_stdio()
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import io
+
+
+class OutputSink(object):
+    """
+    Buffered text output for converters.
+
+    Text is collected as unicode and encoded in one go whenever the buffer
+    holds buffer_size characters, and when the sink is flushed or closed.
+    The target is any binary file-like object, use OutputSink.open() for
+    files and OutputSink.memory() to keep the output in memory.
+    """
+    BUFFER_SIZE = 256 * 1024
+
+    def __init__(self, target, encoding='utf-8', buffer_size=BUFFER_SIZE, close_target=False):
+        self.target = target
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self.close_target = close_target
+        self.buffer = []
+        self.size = 0
+
+    @classmethod
+    def open(cls, filename, mode='a', **kwargs):
+        """Open filename for writing (default: append)."""
+        return cls(open(filename, mode + 'b'), close_target=True, **kwargs)
+
+    @classmethod
+    def memory(cls, **kwargs):
+        """Sink with an in-memory target, see getvalue()."""
+        return cls(io.BytesIO(), **kwargs)
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.size += len(text)
+        if self.size >= self.buffer_size:
+            self.flush()
+
+    def writeline(self, *parts):
+        """Write parts separated by spaces and a newline, like print()."""
+        self.write(' '.join(parts))
+        self.write('\n')
+
+    def flush(self):
+        if self.buffer:
+            self.target.write(''.join(self.buffer).encode(self.encoding))
+            self.buffer = []
+            self.size = 0
+
+    def close(self):
+        self.flush()
+        if self.close_target:
+            self.target.close()
+
+    def getvalue(self):
+        """Return everything written to an in-memory target (as bytes)."""
+        self.flush()
+        return self.target.getvalue()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class KeepOpen(object):
+    """
+    Binary target owned by the caller (see tdconv.convert_stream()):
+    close() flushes the target, but leaves it open.
+    """
+
+    def __init__(self, target):
+        self.target = target
+
+    def write(self, data):
+        self.target.write(data)
+
+    def flush(self):
+        flush = getattr(self.target, 'flush', None)
+        if flush:
+            flush()
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import logging
+import mmap
+import os
+
+
+logger = logging.getLogger("tdconv")
+
+
+class MappedSource(object):
+    """
+    Read-only, binary file object on a memory mapped file.
+
+    Iterating yields lines (split at \\n like a file does), read() returns
+    bytes, so a MappedSource can be handed to csv.reader and ET.iterparse.
+    Every line is copied out of the map once, by mmap.readline(), without
+    a file buffer in between. The file must not be empty.
+    """
+
+    def __init__(self, filename):
+        self.name = filename
+        self.file = open(filename, 'rb')
+        try:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        except BaseException:
+            self.file.close()
+            raise
+        self.size = len(self.map)
+
+    def __iter__(self):
+        return iter(self.map.readline, b'')
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self.size - self.map.tell()
+        return self.map.read(size)
+
+    def readline(self):
+        return self.map.readline()
+
+    def fileno(self):
+        return self.file.fileno()
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_source(filename, mapped=False):
+    """
+    Open a source file for reading in binary mode. With mapped, a non-empty
+    regular file is memory mapped.
+    """
+    if mapped and os.path.isfile(filename) and os.path.getsize(filename):
+        try:
+            return MappedSource(filename)
+        except (EnvironmentError, ValueError) as e:
+            logger.debug("can't map '%s': %s" % (filename, e))
+    return open(filename, 'rb')
@@ -3,80 +3,80 @@
 from __future__ import print_function
 from __future__ import unicode_literals
 
-import codecs
 from string import Template
-from unicode_csv import UnicodeReader, UnicodeWriter
 
-from common import Converter, Downloadable
+from common import Converter, Downloadable, IndentCache
 
 
 class CsvToTaskPaperConverter(Downloadable, Converter):
-    TP_TASK = Template('$indent- $content')
-    TP_PROJECT = Template('$indent$content:')
-    TP_NOTE = Template('$indent$content')
     TP_TOP_PROJECT = Template('$title:')
     TP_UNCLICABLE_TASK_PREFIX = '* '
+    TABS = IndentCache('\t')
     EXT = 'taskpaper'
 
-    def convert(self):
+    def start(self):
+        super(CsvToTaskPaperConverter, self).start()
         self.indent = 1
-        with codecs.open(self.target_name, 'a+', 'utf-8') as self.target:
-            # Add file name as top level project (all tasks belong to that project)
-            self._print(self.TP_TOP_PROJECT.substitute(title=self.title(self.source_name)))
-            super(CsvToTaskPaperConverter, self).convert()
+        self.target = self._open_target()
+        # Add file name as top level project (all tasks belong to that project)
+        self._print(self.TP_TOP_PROJECT.substitute(title=self.title(self.source_name)))
+
+    def finish(self):
+        try:
+            super(CsvToTaskPaperConverter, self).finish()
             self._print('\n')
+        finally:
+            self.target.close()
+
+    def abort(self):
+        super(CsvToTaskPaperConverter, self).abort()
+        self.target.close()
 
     def process_task(self, row):
-        """Convert one task to TaskPaper."""
+        """
+        Convert one task to TaskPaper: '<tabs>- <content>' for tasks,
+        '<tabs><content>:' for 'unclickable' (sub-)tasks, which are treated as
+        projects. Priority 1-3 and due date are added as tags, tags starting
+        with '@/' are cleaned up because TaskPaper does not like them.
+        """
+        self.indent = int(row.indent)
         content = row.content
-        # treat 'unclickable' (sub-)tasks as projects
+        if '@/' in content:
+            content = content.replace('@/', '@')
         if content.startswith(self.TP_UNCLICABLE_TASK_PREFIX):
-            tpl = self.TP_PROJECT
-            content = content[2:]
+            line = [self.TABS[self.indent], content[2:]]
+            end = ':\n'
         else:
-            tpl = self.TP_TASK
-
-        content = self._add_priority(row, content)
-        content = self._add_due_date(row, content)
-        content = self._clean_tags(row, content)
-        self.indent = int(row.indent)
-        self._print(tpl.substitute(indent='\t' * (int(row.indent)), content=content))
-
-    def _add_priority(self, row, content):
-        """Add priority tag for prio 1-3."""
-        if row.priority != '' and int(row.priority) < 4:
-            content = ''.join((content, ' @priority(%s)' % row.priority))
-        return content
-
-    def _add_due_date(self, row, content):
-        """Add @due(date)."""
-        if row.date:
-            content = ''.join((content, ' @due(%s)' % row.date))
-        return content
-
-    def _clean_tags(self, row, content):
-        """Taskpaper does not like tags starting with '@/'."""
-        return content.replace('@/', '@')
+            line = [self.TABS[self.indent], '- ', content]
+            end = '\n'
+        priority = row.priority
+        if priority != '' and int(priority) < 4:
+            line.extend((' @priority(', priority, ')'))
+        date = row.date
+        if date:
+            line.extend((' @due(', date.replace('@/', '@'), ')'))
+        line.append(end)
+        self.target.write(''.join(line))
 
     def process_note(self, note):
         """Convert one note to TaskPaper."""
-        tabs = '\t' * (self.indent + 1)  # notes need an additional level of indentation
+        tabs = self.TABS[self.indent + 1]  # notes need an additional level of indentation
         self._process_note_text(note.text, tabs)
         self._process_note_attachment(note.attachment, tabs)
 
     def _process_note_text(self, text, tabs):
         if text:
-            for line in text.split('\n'):
-                self._print(self.TP_NOTE.substitute(indent=tabs, content=line))
+            separator = '\n' + tabs
+            self.target.write(''.join((tabs, text.replace('\n', separator), '\n')))
 
     def _process_note_attachment(self, attachment, tabs):
         if attachment:
             if self.download_attachments:
-                relpath = attachment.download()
+                relpath = self.download(attachment)
                 content = self.tp_file(relpath)
             else:
                 content = ': '.join((attachment.name, attachment.url))
-            self._print(self.TP_NOTE.substitute(indent=tabs, content=content))
+            self.target.write(''.join((tabs, content, '\n')))
 
     @staticmethod
     def tp_file(relpath):
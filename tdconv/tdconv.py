@@ -4,13 +4,28 @@ from __future__ import print_function
 from __future__ import unicode_literals
 
 import argparse
-import codecs
+from argparse import Namespace
+from collections import namedtuple
+import glob
+import io
 import logging
+import multiprocessing
+import sys
 from textwrap import dedent
+import time
+import traceback
 import zipfile
 import os
+from cache import DEFAULT_CACHE_SIZE
+from common import ConverterGroup
+from download import DEFAULT_DOWNLOAD_BUFFER, DEFAULT_DOWNLOAD_THREADS
+from instrument import Profile
+from manifest import ZipManifest
 from markdown import CsvToMarkdownConverter
+from outline_cache import DEFAULT_OUTLINE_CACHE_SIZE, OutlineCache
+from progress import ConversionCancelled
 from opml import OpmlToCsvConverter, CsvToOpmlConverter
+from source import open_source
 from taskpaper import CsvToTaskPaperConverter
 
 logger = logging.getLogger("tdconv")
@@ -21,53 +36,449 @@ FORMAT_CSV = 'todoist'
 FORMAT_TASKPAPER = 'taskpaper'
 
 
+CONVERTERS = {
+    FORMAT_MD: CsvToMarkdownConverter,
+    FORMAT_OPML: CsvToOpmlConverter,
+    FORMAT_CSV: OpmlToCsvConverter,
+    FORMAT_TASKPAPER: CsvToTaskPaperConverter,
+}
+
+
+class FormatError(Exception):
+    pass
+
+
+def parse_formats(format):
+    """
+    Return a list of (format, converter class) for a comma separated list
+    of target formats. A single unknown format is converted to Markdown,
+    in a list every format must be known and appear once, because each
+    writes its own target.
+    """
+    names = [name.strip() for name in format.lower().split(',')]
+    if len(names) == 1:
+        return [(names[0], CONVERTERS.get(names[0], CsvToMarkdownConverter))]
+    for name in names:
+        if name not in CONVERTERS:
+            raise FormatError("unknown format '%s' in '%s'" % (name, format))
+        if names.count(name) > 1:
+            raise FormatError("format '%s' is given more than once" % name)
+    if FORMAT_CSV in names:
+        raise FormatError("format '%s' can't be combined with other formats" % FORMAT_CSV)
+    return [(name, CONVERTERS[name]) for name in names]
+
+
+def make_converter(formats, args, source_file, targets, stats=None):
+    """
+    Return a converter for source_file, which reads the source once for
+    all formats. targets has one target name per format, stats are the
+    instrument.Stats if the conversion is profiled.
+    """
+    converters = [klass(args, source_file, target) for (name, klass), target in zip(formats, targets)]
+    if len(converters) == 1:
+        converters[0].stats = stats
+        return converters[0]
+    return ConverterGroup(converters, stats)
+
+
+def make_profile(args):
+    """Return a Profile if args ask for one (see --profile), else None."""
+    if getattr(args, 'profile', None):
+        return Profile(args.profile, getattr(args, 'profile_dump', None))
+    return None
+
+
 def convert(args):
     """
     Convert file to specified format.
     Rows: TYPE (task, note),CONTENT,PRIORITY(1-4),INDENT,AUTHOR,RESPONSIBLE,DATE,DATE_LANG
     """
+    formats = parse_formats(args.format)
+    if getattr(args, 'clear_outline_cache', False) and getattr(args, 'outline_cache', None):
+        OutlineCache(args.outline_cache).invalidate()
 
-    if args.format.lower() == FORMAT_OPML:
-        klass = CsvToOpmlConverter
-    elif args.format.lower() == FORMAT_CSV:
-        klass = OpmlToCsvConverter
-    elif args.format.lower() == FORMAT_TASKPAPER:
-        klass = CsvToTaskPaperConverter
-    else:
-        klass = CsvToMarkdownConverter
-
-    if os.path.splitext(args.file)[1].lower() == '.zip':
-        process_zip(klass, args)
-    else:
-        with codecs.open(args.file, 'r') as source_file:
-            if args.output:
-                target = args.output
+    profile = make_profile(args)
+    try:
+        if os.path.isdir(args.file):
+            process_directory(formats, args, profile)
+        elif os.path.splitext(args.file)[1].lower() == '.zip':
+            process_zip(formats, args, profile)
+        else:
+            if args.output and len(formats) > 1:
+                # with several formats, output is the name of the targets without extension
+                root = os.path.splitext(args.output)[0]
+                targets = ['.'.join((root, klass.EXT)) for name, klass in formats]
+            elif args.output:
+                targets = [args.output]
             else:
-                target = ''
-            converter = klass(args, source_file, target)
-            converter.convert()
+                targets = [''] * len(formats)
+            if profile:
+                profile.run(args.file, convert_file, formats, args, targets)
+            else:
+                convert_file(None, formats, args, targets)
+            if getattr(args, 'progress', None):
+                args.progress.file_done()
+    finally:
+        if profile:
+            profile.save()
+
+
+def convert_stream(src, dst=None, format=FORMAT_MD, name=None, **options):
+    """
+    Convert src to a single format in memory, without files for source
+    and target. Return the result as bytes if dst is None.
+
+    src is bytes or a binary file-like object (CSV, or OPML for format
+    todoist), the result is written to the binary file-like object dst,
+    which is left open. name is used for the title (default: src.name if
+    src has one). options are those of convert(), e.g. download=True, which
+    downloads attachments to the current directory.
+    """
+    formats = parse_formats(format)
+    if len(formats) > 1:
+        raise FormatError("convert_stream() can't convert to several formats ('%s')" % format)
+    if isinstance(src, bytes):
+        src = io.BytesIO(src)
+    if name is None:
+        name = getattr(src, 'name', '')
+    args = Namespace(**dict(dict(download=False, output=None), **options))
+    args.file = name
+    args.format = format
+    target = io.BytesIO() if dst is None else dst
+    klass = formats[0][1]
+    klass(args, src, target_file=target).convert()
+    if dst is None:
+        return target.getvalue()
 
 
-def process_zip(converter_class, args):
-    """convert all files in a zip file."""
+def convert_file(stats, formats, args, targets):
+    with open_source(args.file, getattr(args, 'mmap', False)) as source_file:
+        converter = make_converter(formats, args, source_file, targets, stats)
+        converter.convert()
+
+
+def convert_zip_member(stats, archive, member, formats, args, targets):
+    """Convert member (a name or ZipInfo) of archive."""
+    with archive.open(member, 'r') as source_file:
+        converter = make_converter(formats, args, source_file, targets, stats)
+        converter.convert()
+
+
+JOBS_WITH_DOWNLOAD = '--jobs can\'t be combined with --download, files are converted one after the other'
+PROFILE_DUMP_WITHOUT_PROFILE = '--profile-dump needs --profile'
+
+
+def args_error(args):
+    """Return why the combination of options in args is invalid, or None."""
+    if (getattr(args, 'jobs', None) or 1) > 1 and getattr(args, 'download', False):
+        return JOBS_WITH_DOWNLOAD
+    if getattr(args, 'profile_dump', None) and not getattr(args, 'profile', None):
+        return PROFILE_DUMP_WITHOUT_PROFILE
+    return None
+
+
+ZipSummary = namedtuple('ZipSummary', 'converted skipped seconds_saved')
+
+
+def process_zip(formats, args, profile=None):
+    """
+    convert all files in a zip file.
+
+    Members are converted one after the other, the first error stops the
+    conversion. With args.jobs, members are converted in a pool of worker
+    processes, with the same output as a sequential run: a member that
+    fails doesn't stop the others, errors are logged and raised together
+    as ZipConversionError (in member order) once all members are done, and
+    members that would write the same target (which a sequential run
+    appends to one another) are rejected up front. args.download converts
+    sequentially, see args_error().
+
+    With args.incremental, members that are unchanged since the last run
+    (according to the manifest in the target directory) are skipped.
+    With a Profile, every member is profiled. Returns a ZipSummary.
+    """
+    progress = getattr(args, 'progress', None)
     zip_path = args.file
     source_directory = os.path.split(zip_path)[0]
     print(source_directory)
     print(zip_path)
-    target_extension = args.format
-    if target_extension == 'todoist':
-        target_extension == 'csv'
-    with zipfile.ZipFile(zip_path, 'r') as archive:
-        for info in archive.infolist():
-            if info.filename.lower().endswith('.csv'):
-                # limit processing to CSV-files
+    jobs = getattr(args, 'jobs', 1) or 1
+    if jobs > 1 and getattr(args, 'download', False):
+        # workers would compete for the names in attachments/, so the names would depend on scheduling
+        logger.warning(JOBS_WITH_DOWNLOAD)
+        jobs = 1
+    manifest = ZipManifest(source_directory) if getattr(args, 'incremental', False) else None
+    options = dict(download=bool(getattr(args, 'download', False)))
+    members = []
+    converted = []
+    errors = []
+    skipped = 0
+    seconds_saved = 0.0
+
+    def record(info, targets, seconds, report):
+        converted.append(info.filename)
+        if manifest:
+            manifest.record(info, targets, options, seconds)
+        if profile and report:
+            profile.inputs.append(report)
+        if progress:
+            progress.file_done()
+
+    try:
+        with zipfile.ZipFile(zip_path, 'r') as archive:
+            # limit processing to CSV-files
+            infos = [info for info in archive.infolist() if info.filename.lower().endswith('.csv')]
+            member_targets = []
+            for info in infos:
+                targets = []
+                for target_extension, klass in formats:
+                    if target_extension == 'todoist':
+                        target_extension == 'csv'
+                    targets.append(make_target_filename(source_directory, info.filename, target_extension))
+                member_targets.append((info, targets))
+            if jobs > 1:
+                check_target_collisions(member_targets)
+            if progress:
+                progress.add_files(len(infos))
+            for info, targets in member_targets:
+                if progress:
+                    progress.checkpoint()
                 logger.debug(info.filename)
                 print(info.filename, repr(info))
-                target_filename = make_target_filename(source_directory, info.filename, target_extension)
-                print(target_filename)
-                source_file = archive.open(info, 'r')
-                converter = converter_class(args, source_file, target_filename)
-                converter.convert()
+                print(', '.join(targets))
+                if manifest:
+                    if manifest.is_current(info, targets, options):
+                        logger.info("skipping unchanged '%s'" % info.filename)
+                        skipped += 1
+                        seconds_saved += manifest.seconds(targets)
+                        if progress:
+                            progress.file_done()
+                        continue
+                    # targets are appended to, start from scratch
+                    for target in targets:
+                        open(target, 'w').close()
+                if jobs > 1:
+                    members.append((info, targets))
+                else:
+                    started = time.time()
+                    if profile:
+                        profile.run(info.filename, convert_zip_member, archive, info, formats, args, targets)
+                    else:
+                        convert_zip_member(None, archive, info, formats, args, targets)
+                    record(info, targets, time.time() - started, None)
+        if members:
+            by_name = dict((info.filename, (info, targets)) for info, targets in members)
+
+            def record_member(name, seconds, report):
+                info, targets = by_name[name]
+                record(info, targets, seconds, report)
+
+            if progress:
+                # a Progress can't be sent to the worker processes
+                args = Namespace(**dict(vars(args), progress=None))
+            errors = run_in_pool(
+                _convert_zip_member, [(formats, args, info.filename, targets) for info, targets in members], jobs,
+                record_member, progress, _init_zip_worker, (zip_path,))
+    finally:
+        if manifest:
+            manifest.save()
+    summary = ZipSummary(len(converted), skipped, seconds_saved)
+    if manifest:
+        print('converted %s, skipped %s unchanged member(s), saved about %.1f seconds' % summary)
+    if errors:
+        raise ZipConversionError(errors)
+    return summary
+
+
+class TargetCollisionError(Exception):
+    pass
+
+
+def check_target_collisions(member_targets):
+    """
+    Raise TargetCollisionError if two members (e.g. x/a.csv and y/a.csv)
+    would be converted to the same target.
+    """
+    members = {}
+    for info, targets in member_targets:
+        for target in targets:
+            other = members.setdefault(target, info.filename)
+            if other != info.filename:
+                raise TargetCollisionError("members '%s' and '%s' would both be converted to '%s'"
+                                           % (other, info.filename, target))
+
+
+class ConversionError(Exception):
+    """One or more files could not be converted."""
+
+    def __init__(self, errors, what='file(s)'):
+        super(ConversionError, self).__init__(
+            '%s %s failed: %s' % (len(errors), what, ', '.join(name for name, tb in errors)))
+        self.errors = errors
+
+
+class ZipConversionError(ConversionError):
+    """One or more members of a zip file could not be converted."""
+
+    def __init__(self, errors):
+        super(ZipConversionError, self).__init__(errors, 'member(s)')
+
+
+def run_in_pool(function, items, jobs, converted=None, progress=None, initializer=None, initargs=()):
+    """
+    Call function for every item in a pool of at most jobs worker processes,
+    function returns (name, traceback or None, seconds, profile report or None).
+
+    converted(name, seconds, profile report or None) is called for every
+    item that was converted successfully. Results are collected in item
+    order, so errors are reported in the same order as in a sequential run.
+    Errors are logged and returned as a list of (name, traceback). If
+    progress is cancelled, the workers are terminated.
+    """
+    pool = multiprocessing.Pool(min(jobs, len(items)), initializer, initargs)
+    errors = []
+    try:
+        for name, tb, seconds, report in pool.imap(function, items):
+            if tb:
+                logger.error("error converting '%s':\n%s" % (name, tb))
+                errors.append((name, tb))
+            elif converted:
+                converted(name, seconds, report)
+            if progress:
+                progress.checkpoint()
+    except BaseException:
+        pool.terminate()
+        raise
+    else:
+        pool.close()
+    finally:
+        pool.join()
+    return errors
+
+
+_worker_archive = None
+
+
+def _init_zip_worker(zip_path):
+    global _worker_archive
+    _worker_archive = zipfile.ZipFile(zip_path, 'r')
+
+
+def _convert_zip_member(member):
+    """
+    Convert one zip member in a worker process,
+    return (filename, traceback or None, seconds, profile report or None).
+    """
+    formats, args, filename, targets = member
+    return _convert_in_worker(filename, args, convert_zip_member,
+                              _worker_archive, filename, formats, args, targets)
+
+
+def _convert_in_worker(name, args, function, *function_args):
+    """
+    Call function(stats, *function_args), profiled if args ask for it, and return
+    (name, traceback or None, seconds, profile report or None). Also used for
+    sequential conversions, a cancelled conversion is raised, not returned.
+    """
+    profile = make_profile(args)
+    started = time.time()
+    try:
+        if profile:
+            profile.run(name, function, *function_args)
+        else:
+            function(None, *function_args)
+    except ConversionCancelled:
+        raise
+    except Exception:
+        return name, traceback.format_exc(), time.time() - started, None
+    return name, None, time.time() - started, profile.inputs[0] if profile else None
+
+
+DirectorySummary = namedtuple('DirectorySummary', 'converted failed')
+
+
+def source_extension(formats):
+    """Extension of the source files for formats: OPML for the todoist format, CSV otherwise."""
+    if formats[0][1] is OpmlToCsvConverter:
+        return FORMAT_OPML
+    return 'csv'
+
+
+def process_directory(formats, args, profile=None):
+    """
+    Convert all source files in directory args.file (see source_extension())
+    next to the source files, or into directory args.output.
+
+    Files are converted in a pool of args.jobs worker processes, by
+    default one per CPU (one after the other with args.download). A file
+    that fails doesn't stop the others, errors are logged and raised
+    together as ConversionError once all files are done. Returns a
+    DirectorySummary.
+    """
+    progress = getattr(args, 'progress', None)
+    directory = args.file
+    target_directory = determine_target_directory(directory, args.output)
+    jobs = getattr(args, 'jobs', None) or multiprocessing.cpu_count()
+    if jobs > 1 and getattr(args, 'download', False):
+        # workers would compete for the names in attachments/, as for zip files
+        logger.warning(JOBS_WITH_DOWNLOAD)
+        jobs = 1
+    pattern = '*.' + source_extension(formats)
+    sources = sorted(filename for filename in glob.glob(os.path.join(directory, pattern))
+                     if os.path.isfile(filename))
+    if not sources:
+        logger.error("No files matching pattern '%s' in directory '%s'" % (pattern, directory))
+    if progress:
+        progress.add_files(len(sources))
+    files = []
+    for source in sources:
+        targets = [make_target_filename(target_directory, source, klass.EXT) for name, klass in formats]
+        # the converters append to their targets
+        for target in targets:
+            open(target, 'w').close()
+        # args of every file, the name of the source is used as title
+        files.append((formats, Namespace(**dict(vars(args), file=source, progress=None)), targets))
+
+    converted = []
+
+    def record(name, seconds, report):
+        logger.info("converted '%s' in %.2f seconds" % (name, seconds))
+        converted.append(name)
+        if profile and report:
+            profile.inputs.append(report)
+        if progress:
+            progress.file_done()
+
+    if jobs > 1 and len(files) > 1:
+        errors = run_in_pool(_convert_directory_file, files, jobs, record, progress)
+    else:
+        errors = []
+        for formats, file_args, targets in files:
+            if progress:
+                progress.checkpoint()
+                # in the same process, rows and downloads are reported and can be cancelled
+                file_args.progress = progress
+            name, tb, seconds, report = _convert_in_worker(
+                file_args.file, file_args, convert_file, formats, file_args, targets)
+            if tb:
+                logger.error("error converting '%s':\n%s" % (name, tb))
+                errors.append((name, tb))
+            else:
+                record(name, seconds, report)
+    summary = DirectorySummary(len(converted), len(errors))
+    logger.info('converted %s file(s) in %s, %s failed' % (len(converted), directory, len(errors)))
+    if errors:
+        raise ConversionError(errors)
+    return summary
+
+
+def _convert_directory_file(item):
+    """
+    Convert one file of a directory in a worker process,
+    return (filename, traceback or None, seconds, profile report or None).
+    """
+    formats, args, targets = item
+    return _convert_in_worker(args.file, args, convert_file, formats, args, targets)
 
 
 def make_target_filename(directory, source_filename, target_extension):
@@ -93,23 +504,74 @@ def determine_target_directory(source_dir, output):
     return source_dir
 
 
-def main():
-    parser = argparse.ArgumentParser(
+def make_parser(parser_class=argparse.ArgumentParser, **kwargs):
+    """Return the parser for the conversion options (without the file argument)."""
+    parser = parser_class(
         description=dedent("""Convert Todoist template files (and Todoist backups) to other formats.
-            To convert an entire backup use
-            ls -bp | xargs -I xx tdconv -df taskpaper "xx"
-            """))
+            To convert an entire backup, pass the backup zip file or the directory it was unpacked to.
+            Run "tdconv serve --help" for a conversion server that converts many files without
+            starting a new process for each.
+            """), **kwargs)
 
     parser.add_argument('--verbose', '-v', action='count', default=0,
                         help='increase level of verbosity (repeat up to 3 times)')
     parser.add_argument('--format', '-f', default='md',
-                        help='format of target file: md, opml, todoist, taskpaper')
+                        help='format of target file: md, opml, todoist, taskpaper; '
+                             'several CSV target formats can be combined, e.g. md,taskpaper,opml')
     parser.add_argument('--output', '-o', default=None,
-                        help='name of target file, if this argument is not present, name of source file will be used')
+                        help='name of target file, if this argument is not present, name of source file will be used '
+                             '(with several formats, the extension of each format is added)')
     parser.add_argument('--download', '-d', action="store_true", default=False,
                         help='download attachments')
+    parser.add_argument('--download-threads', type=int, default=DEFAULT_DOWNLOAD_THREADS,
+                        help='number of parallel attachment downloads, limited to one per 4096 bytes of '
+                             '--download-buffer (default: %(default)s)')
+    parser.add_argument('--download-buffer', type=int, default=DEFAULT_DOWNLOAD_BUFFER,
+                        help='maximum number of bytes buffered by all downloads (default: %(default)s)')
+    parser.add_argument('--cache', default=None, metavar='DIR',
+                        help='keep downloaded attachments in DIR and reuse them in later runs')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE,
+                        help='maximum size of the attachment cache in bytes (default: %(default)s)')
+    parser.add_argument('--revalidate', action="store_true", default=False,
+                        help='check with the server whether cached attachments have changed')
+    parser.add_argument('--outline-cache', default=None, metavar='DIR',
+                        help='keep the parsed contents of source files in DIR and reuse them while the file '
+                             'is unchanged')
+    parser.add_argument('--outline-cache-size', type=int, default=DEFAULT_OUTLINE_CACHE_SIZE,
+                        help='maximum size of the outline cache in bytes (default: %(default)s)')
+    parser.add_argument('--clear-outline-cache', action="store_true", default=False,
+                        help='remove all entries from the outline cache before converting')
+    parser.add_argument('--incremental', '-i', action="store_true", default=False,
+                        help='only convert the members of a zip file that changed since the last incremental run')
+    parser.add_argument('--mmap', action="store_true", default=False,
+                        help='read source files through a memory map')
+    parser.add_argument('--profile', default=None, metavar='REPORT',
+                        help='write timers and counters for every input file as JSON to REPORT')
+    parser.add_argument('--profile-dump', default=None, metavar='DIR',
+                        help='with --profile, also write a cProfile dump for every input file to DIR')
+    parser.add_argument('--jobs', '-j', type=int, default=None,
+                        help='number of worker processes for converting the members of a zip file (default: 1) '
+                             'or the files in a directory (default: number of CPUs); can\'t be combined with '
+                             '--download, which converts one file after the other')
+    return parser
+
+
+def main():
+    if sys.argv[1:2] == ['serve']:
+        # imported here, serve imports this module
+        import serve
+        return serve.main(sys.argv[2:])
+    if sys.argv[1:2] == ['submit']:
+        import client
+        return client.main(sys.argv[2:])
+
+    parser = make_parser()
     parser.add_argument('file',
-                        help='file to convert (either csv, opml or a zip file that contains csv files')
+                        help='file to convert (either csv, opml, a zip file that contains csv files '
+                             'or a directory of csv files, or of opml files with --format todoist)')
 
     args = parser.parse_args()
+    error = args_error(args)
+    if error:
+        parser.error(error)
     convert(args)
@@ -1,67 +1,59 @@
-"""UnicodeReader and UnicodeWriter for CSV as described in the Python documentation."""
+"""UnicodeWriter for CSV as described in the Python documentation, and skip_bom() for reading."""
 
 import csv
 import codecs
 import cStringIO
+import itertools
 
 
-class UTF8Recoder:
-    """
-    Iterator that reads an encoded stream and reencodes the input to UTF-8
-    """
-    def __init__(self, f, encoding):
-        self.reader = codecs.getreader(encoding)(f)
-
-    def __iter__(self):
-        return self
-
-    def next(self):
-        return self.reader.next().encode("utf-8")
-
-
-class UnicodeReader:
-    """
-    A CSV reader which will iterate over lines in the CSV file "f",
-    which is encoded in the given encoding.
-    """
-
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        f = UTF8Recoder(f, encoding)
-        self.reader = csv.reader(f, dialect=dialect, **kwds)
-
-    def next(self):
-        row = self.reader.next()
-        return [unicode(s, "utf-8") for s in row]
-
-    def __iter__(self):
-        return self
+def skip_bom(f):
+    """Return an iterator over the lines of f without a leading UTF-8 BOM."""
+    lines = iter(f)
+    for first in lines:
+        if first.startswith(codecs.BOM_UTF8):
+            first = first[len(codecs.BOM_UTF8):]
+        return itertools.chain((first,), lines)
+    return lines
 
 
 class UnicodeWriter:
     """
     A CSV writer which will write rows to CSV file "f",
-    which is encoded in the given encoding.
+    which is encoded in the given (ASCII compatible) encoding.
+
+    Cells are encoded once, the csv module writes them to an in-memory
+    buffer, which is written to "f" whenever it holds flush_size bytes.
+    Call flush() after the last row.
     """
+    FLUSH_SIZE = 64 * 1024
+    BATCH_SIZE = 1000
 
-    def __init__(self, f, dialect=csv.excel, encoding="utf-8", **kwds):
-        # Redirect output to a queue
-        self.queue = cStringIO.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+    def __init__(self, f, dialect=csv.excel, encoding="utf-8", flush_size=FLUSH_SIZE, **kwds):
+        self.buffer = cStringIO.StringIO()
+        self.writer = csv.writer(self.buffer, dialect=dialect, **kwds)
         self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
+        self.encoding = encoding
+        self.flush_size = flush_size
 
     def writerow(self, row):
-        self.writer.writerow([s.encode("utf-8") for s in row])
-        # Fetch UTF-8 output from the queue ...
-        data = self.queue.getvalue()
-        data = data.decode("utf-8")
-        # ... and reencode it into the target encoding
-        data = self.encoder.encode(data)
-        # write to the target stream
-        self.stream.write(data)
-        # empty queue
-        self.queue.truncate(0)
+        encoding = self.encoding
+        self.writer.writerow([s.encode(encoding) for s in row])
+        if self.buffer.tell() >= self.flush_size:
+            self.flush()
 
     def writerows(self, rows):
-        for row in rows:
-            self.writerow(row)
+        encoding = self.encoding
+        rows = iter(rows)
+        while True:
+            batch = [[s.encode(encoding) for s in row] for row in itertools.islice(rows, self.BATCH_SIZE)]
+            if not batch:
+                break
+            self.writer.writerows(batch)
+            if self.buffer.tell() >= self.flush_size:
+                self.flush()
+
+    def flush(self):
+        """Write buffered rows to the stream."""
+        self.stream.write(self.buffer.getvalue())
+        self.buffer.seek(0)
+        self.buffer.truncate()
@@ -0,0 +1,425 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for the converters on synthetic Todoist exports.
+
+Generates a Todoist CSV project, the same project as OPML, a zip backup of
+several projects, a large CSV for the reader and attachments for the
+download cases (served from a local HTTP server), then runs every case in
+its own process and reports rows/s and peak RSS:
+
+    python tdconv_bench.py                    # run all cases
+    python tdconv_bench.py csv-to-md zip      # run some cases
+    python tdconv_bench.py --save-baseline    # store results as baseline
+
+Results are compared with the baseline (bench_baseline.json, see
+--baseline) if it exists; a case that is slower or uses more memory than
+the baseline by more than --tolerance is reported as a regression, and
+the exit status is 1.
+"""
+
+from __future__ import print_function
+from __future__ import unicode_literals
+
+import argparse
+from argparse import Namespace
+import BaseHTTPServer
+from collections import OrderedDict
+import json
+import os
+import random
+import resource
+import shutil
+import SimpleHTTPServer
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+
+from tdconv.common import Converter
+from tdconv.const import FIELDNAMES
+from tdconv.markdown import CsvToMarkdownConverter
+from tdconv.opml import CsvToOpmlConverter
+from tdconv.source import open_source
+from tdconv.tdconv import convert, convert_stream, parse_formats, process_zip
+
+BASELINE = 'bench_baseline.json'
+# notes of the task in the many-notes cases, the time per note must not grow with it
+MANY_NOTES = (1000, 10000, 100000)
+# allowed growth of the time per note from the smallest to the largest many-notes case
+SCALING_BOUND = 2.0
+
+WORDS = ('call', 'review', 'draft', 'plan', 'buy', 'fix', 'write', 'read', 'email', 'check',
+         'garden', 'report', 'invoice', 'meeting', 'project', 'tickets', 'Müller', 'café')
+
+
+def generate_csv(path, rows, depth=4, note_size=200, notes=0.5, attachments=0.1, seed=1):
+    """
+    Write a Todoist CSV with (about) rows task and note rows: tasks are
+    nested up to depth levels, each task has notes notes on average,
+    attachments is the share of notes that have an attachment.
+    """
+    random.seed(seed)
+    written = 0
+    with open(path, 'wb') as f:
+        f.write(','.join(FIELDNAMES).encode('utf-8') + b'\r\n')
+        level = 1
+        while written < rows:
+            content = ' '.join(random.choice(WORDS) for i in range(6))
+            f.write(csv_line(['task', content, str(random.randint(1, 4)), str(level),
+                              'Bench (1)', '', 'in 5 days', 'en', 'Europe/Berlin']))
+            written += 1
+            while written < rows and random.random() < notes / (1.0 + notes):
+                f.write(csv_line(['note', make_note(note_size, attachments), '', '', 'Bench (1)', '', '', '', '']))
+                written += 1
+            f.write(b',,,,,,,,\r\n')
+            level = random.randint(1, min(level + 1, depth))
+    return written
+
+
+def make_note(note_size, attachments):
+    text = ' '.join(random.choice(WORDS) for i in range(max(1, note_size // 6)))[:note_size]
+    if random.random() < attachments:
+        name = '%s-%s.png' % (random.choice(WORDS), random.randint(1, 10 ** 6))
+        attachment = json.dumps({'file_name': name, 'file_type': 'image/png', 'file_size': 1234,
+                                 'file_url': 'https://files.example.com/%s' % name, 'resource_type': 'file'})
+        return '%s\n\n[[file %s]]' % (text, attachment)
+    return text
+
+
+def csv_line(cells):
+    return b','.join(b'"%s"' % cell.replace('"', '""').encode('utf-8') for cell in cells) + b'\r\n'
+
+
+def generate_many_notes(path, notes, note_size):
+    """Write a CSV with a single task that has many notes."""
+    with open(path, 'wb') as f:
+        f.write(','.join(FIELDNAMES).encode('utf-8') + b'\r\n')
+        f.write(csv_line(['task', 'task with many notes', '4', '1', '', '', '', 'en', '']))
+        for i in range(notes):
+            f.write(csv_line(['note', make_note(note_size, 0), '', '', '', '', '', '', '']))
+    return notes + 1
+
+
+def generate_attachments(directory, count, size):
+    """Write count attachments of size bytes into directory, return the rows of a project that has them."""
+    os.mkdir(directory)
+    for i in range(count):
+        with open(os.path.join(directory, 'file-%s.bin' % i), 'wb') as f:
+            f.write(os.urandom(size))
+    # a task and a note per attachment
+    return count + 1
+
+
+def generate_data(directory, options):
+    """Generate all sources in directory, return the number of rows per source."""
+    rows = OrderedDict()
+    project = os.path.join(directory, 'project.csv')
+    rows['project.csv'] = generate_csv(project, options.rows, options.depth, options.note_size,
+                                       options.notes, options.attachments)
+    with open(project, 'rb') as source:
+        CsvToOpmlConverter(Namespace(file=project), source, os.path.join(directory, 'project.opml')).convert()
+    rows['project.opml'] = rows['project.csv']
+    rows['reader.csv'] = generate_csv(os.path.join(directory, 'reader.csv'), options.reader_rows, options.depth,
+                                      options.note_size, options.notes, options.attachments, seed=2)
+    for notes in MANY_NOTES:
+        name = 'many-notes-%s.csv' % notes
+        rows[name] = generate_many_notes(os.path.join(directory, name), notes, options.note_size)
+    rows['downloads.csv'] = generate_attachments(os.path.join(directory, 'attachments'),
+                                                 options.downloads, options.download_size)
+    rows['backup.zip'] = 0
+    with zipfile.ZipFile(os.path.join(directory, 'backup.zip'), 'w', zipfile.ZIP_DEFLATED) as archive:
+        member = os.path.join(directory, 'member.csv')
+        for i in range(options.projects):
+            rows['backup.zip'] += generate_csv(member, options.rows // options.projects, options.depth,
+                                               options.note_size, options.notes, options.attachments, seed=10 + i)
+            archive.write(member, 'Project %s [%s].csv' % (i, 1000000 + i))
+        os.remove(member)
+    return rows
+
+
+def read_rows(data, work):
+    source = os.path.join(data, 'reader.csv')
+    with open_source(source) as f:
+        for row in Converter(Namespace(file=source), f, 'unused').rows():
+            row.type
+            row.content
+    return 'reader.csv'
+
+
+def converter_case(source, format, **options):
+    def run(data, work):
+        ext = '.'.join(name for name, klass in parse_formats(format))
+        convert(Namespace(file=os.path.join(data, source), format=format, download=False,
+                          output=os.path.join(work, 'out.' + ext), **options))
+        return source
+    return run
+
+
+def outline_cache_case(source, format):
+    """Replay an unchanged source from a warm outline cache."""
+    def prepare(data, work):
+        cache = os.path.join(work, 'outline-cache')
+        convert(Namespace(file=os.path.join(data, source), format=format, download=False,
+                          output=os.path.join(work, 'warm'), outline_cache=cache))
+        return dict(outline_cache=cache)
+
+    def replay(data, work, **options):
+        convert(Namespace(file=os.path.join(data, source), format=format, download=False,
+                          output=os.path.join(work, 'out'), **options))
+        return source
+    replay.prepare = prepare
+    return replay
+
+
+def stream_case(source, format):
+    """Convert the source in memory with convert_stream()."""
+    def run(data, work):
+        with open(os.path.join(data, source), 'rb') as f:
+            convert_stream(f.read(), format=format, name=source)
+        return source
+    return run
+
+
+class FileServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP/1.1 server for the files in directory, running in a thread."""
+    daemon_threads = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), FileRequestHandler)
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def url(self, name):
+        return 'http://127.0.0.1:%s/%s' % (self.server_address[1], name)
+
+
+class FileRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def translate_path(self, path):
+        return os.path.join(self.server.directory, path.lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+
+def download_case(threads, buffer_size):
+    """
+    Download the generated attachments from a local server, and check
+    that the buffers of all download threads stay within buffer_size.
+    """
+    def prepare(data, work):
+        directory = os.path.join(data, 'attachments')
+        server = FileServer(directory)
+        source = os.path.join(work, 'downloads.csv')
+        with open(source, 'wb') as f:
+            f.write(','.join(FIELDNAMES).encode('utf-8') + b'\r\n')
+            f.write(csv_line(['task', 'task with attachments', '4', '1', '', '', '', 'en', '']))
+            for name in sorted(os.listdir(directory)):
+                attachment = json.dumps({'file_name': name, 'file_url': server.url(name)})
+                f.write(csv_line(['note', '[[file %s]]' % attachment, '', '', '', '', '', '', '']))
+        return dict(source=source)
+
+    def run(data, work, source):
+        args = Namespace(file=source, format='md', download=True, output=None,
+                         download_threads=threads, download_buffer=buffer_size)
+        with open(source, 'rb') as f:
+            converter = CsvToMarkdownConverter(args, f)
+            converter.convert()
+        peak = converter.downloader.peak_buffered
+        assert 0 < peak <= buffer_size, 'download buffers peaked at %s bytes, the cap is %s' % (peak, buffer_size)
+        return 'downloads.csv'
+    run.prepare = prepare
+    return run
+
+
+def zip_case(jobs):
+    def prepare(data, work):
+        shutil.copy(os.path.join(data, 'backup.zip'), work)
+        return {}
+
+    def run(data, work):
+        args = Namespace(file=os.path.join(work, 'backup.zip'), format='taskpaper', download=False,
+                         output=None, jobs=jobs)
+        process_zip(parse_formats('taskpaper'), args)
+        return 'backup.zip'
+    run.prepare = prepare
+    return run
+
+
+def many_notes_case(notes):
+    return 'many-notes-to-opml-%sk' % (notes // 1000)
+
+
+CASES = OrderedDict([
+    ('csv-reader', read_rows),
+    ('csv-to-md', converter_case('project.csv', 'md')),
+    ('csv-to-taskpaper', converter_case('project.csv', 'taskpaper')),
+    ('csv-to-opml', converter_case('project.csv', 'opml')),
+    ('opml-to-csv', converter_case('project.opml', 'todoist')),
+    ('csv-to-md-stream', stream_case('project.csv', 'md')),
+    ('csv-to-all-formats', converter_case('project.csv', 'md,taskpaper,opml')),
+    ('csv-to-taskpaper-mmap', converter_case('project.csv', 'taskpaper', mmap=True)),
+    ('opml-to-csv-mmap', converter_case('project.opml', 'todoist', mmap=True)),
+    ('csv-to-taskpaper-outline-cache', outline_cache_case('project.csv', 'taskpaper')),
+    ('opml-to-csv-outline-cache', outline_cache_case('project.opml', 'todoist')),
+] + [
+    (many_notes_case(notes), converter_case('many-notes-%s.csv' % notes, 'opml'))
+    for notes in MANY_NOTES
+] + [
+    ('download', download_case(4, 1024 * 1024)),
+    ('download-small-buffer', download_case(32, 64 * 1024)),
+    ('zip', zip_case(1)),
+    ('zip-jobs-4', zip_case(4)),
+])
+
+
+def peak_rss():
+    """Peak resident set size of this process in KB."""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024
+    return rss
+
+
+def run_case(name, data):
+    """Run case name (in this process), return its result."""
+    case = CASES[name]
+    work = tempfile.mkdtemp(prefix='tdconv-bench-')
+    cwd = os.getcwd()
+    os.chdir(work)
+    try:
+        options = case.prepare(data, work) if hasattr(case, 'prepare') else {}
+        started = time.time()
+        source = case(data, work, **options)
+        seconds = time.time() - started
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work)
+    with open(os.path.join(data, 'rows.json')) as f:
+        rows = json.load(f)[source]
+    # peak RSS of the child processes (zip with jobs) isn't included
+    return dict(rows=rows, seconds=seconds, rows_per_sec=rows / seconds, peak_rss_kb=peak_rss())
+
+
+def run_case_in_process(name, data):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run-case', name, '--data', data])
+    return json.loads(output.splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """Print a table of results, return the names of regressed cases."""
+    regressions = []
+    print('%-32s %9s %8s %11s %9s  %s' % ('case', 'rows', 'seconds', 'rows/s', 'RSS MB', 'vs. baseline'))
+    for name, result in results.items():
+        line = '%-32s %9d %8.2f %11.0f %9.1f' % (name, result['rows'], result['seconds'],
+                                                 result['rows_per_sec'], result['peak_rss_kb'] / 1024.0)
+        base = baseline.get(name)
+        if base:
+            speed = result['rows_per_sec'] / base['rows_per_sec'] - 1
+            memory = float(result['peak_rss_kb']) / base['peak_rss_kb'] - 1
+            line += '  speed %+.0f%%, memory %+.0f%%' % (speed * 100, memory * 100)
+            if speed < -tolerance or memory > tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print(line)
+    return regressions
+
+
+def check_scaling(results, bound):
+    """
+    Print the time per note of the many-notes cases that were run, return
+    them as regressed if it grows by more than bound from the smallest to
+    the largest case (i.e. converting the notes of a task isn't linear).
+    """
+    cases = [(many_notes_case(notes), notes) for notes in MANY_NOTES]
+    per_note = [(name, results[name]['seconds'] / notes) for name, notes in cases if name in results]
+    if len(per_note) < 2:
+        return []
+    print()
+    for name, seconds in per_note:
+        print('%-32s %8.1f us/note' % (name, seconds * 1e6))
+    growth = per_note[-1][1] / per_note[0][1]
+    print('time per note grows %.1fx from %s to %s (bound: %.1fx)' % (growth, per_note[0][0], per_note[-1][0], bound))
+    if growth > bound:
+        print('REGRESSION: notes are not converted in linear time')
+        return [name for name, seconds in per_note]
+    return []
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the converters on synthetic Todoist exports.')
+    parser.add_argument('cases', nargs='*', metavar='case',
+                        help='cases to run (default: all): %s' % ', '.join(CASES))
+    parser.add_argument('--rows', type=int, default=100000, help='rows per project (default: %(default)s)')
+    parser.add_argument('--reader-rows', type=int, default=1000000,
+                        help='rows for the csv-reader case (default: %(default)s)')
+    parser.add_argument('--depth', type=int, default=4, help='maximum nesting depth of tasks (default: %(default)s)')
+    parser.add_argument('--note-size', type=int, default=200, help='characters per note (default: %(default)s)')
+    parser.add_argument('--notes', type=float, default=0.5, help='notes per task (default: %(default)s)')
+    parser.add_argument('--attachments', type=float, default=0.1,
+                        help='share of notes with an attachment (default: %(default)s)')
+    parser.add_argument('--downloads', type=int, default=32,
+                        help='attachments for the download cases (default: %(default)s)')
+    parser.add_argument('--download-size', type=int, default=512 * 1024,
+                        help='bytes per attachment (default: %(default)s)')
+    parser.add_argument('--projects', type=int, default=20,
+                        help='projects in the zip backup, which has --rows rows in total (default: %(default)s)')
+    parser.add_argument('--baseline', default=BASELINE, help='baseline file (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true', default=False,
+                        help='store the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slow-down and memory growth against the baseline (default: %(default)s)')
+    parser.add_argument('--scaling-bound', type=float, default=SCALING_BOUND,
+                        help='allowed growth of the time per note from the smallest to the largest '
+                             'many-notes case (default: %(default)s)')
+    parser.add_argument('--data', default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--run-case', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_case:
+        print(json.dumps(run_case(args.run_case, args.data)))
+        return
+
+    unknown = [name for name in args.cases if name not in CASES]
+    if unknown:
+        parser.error('unknown case(s): %s' % ', '.join(unknown))
+    data = tempfile.mkdtemp(prefix='tdconv-bench-data-')
+    try:
+        print('generating data in %s' % data)
+        with open(os.path.join(data, 'rows.json'), 'w') as f:
+            json.dump(generate_data(data, args), f)
+        results = OrderedDict()
+        for name in args.cases or CASES:
+            results[name] = run_case_in_process(name, data)
+    finally:
+        shutil.rmtree(data)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    parameters = dict((key, getattr(args, key)) for key in
+                      ('rows', 'reader_rows', 'depth', 'note_size', 'notes', 'attachments', 'projects',
+                       'downloads', 'download_size'))
+    if baseline and baseline.get('parameters') != parameters:
+        print('warning: the baseline was recorded with different parameters: %s' % baseline.get('parameters'))
+    regressions = compare(results, baseline.get('results', {}), args.tolerance)
+    regressions += check_scaling(results, args.scaling_bound)
+    if args.save_baseline:
+        baseline.setdefault('results', {}).update(results)
+        baseline['parameters'] = parameters
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, indent=1, sort_keys=True)
+        print('saved baseline to %s' % args.baseline)
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,38 @@
 # -*- coding: utf-8 -*-
 
 from argparse import Namespace
+import BaseHTTPServer
+import codecs
 import filecmp
+import io
+import json
 import os
 import shutil
+import SimpleHTTPServer
+import SocketServer
+import stat
 import tempfile
+import threading
 import unittest
+import urlparse
+import xml.etree.cElementTree as ET
+import zipfile
 
-from tdconv.tdconv import convert
+from tdconv.common import Converter, ConverterGroup, Row
+from tdconv.markdown import CsvToMarkdownConverter
+from tdconv.note import FilenameAllocator, Note, ParsedNotes
+from tdconv.opml import CsvToOpmlConverter, OpmlToCsvConverter, OpmlWriter
+from tdconv.outline_cache import OutlineCache
+from tdconv.progress import ConversionCancelled, Progress
+from tdconv.client import submit
+from tdconv.serve import ConversionServer
+from tdconv.sink import OutputSink
+from tdconv.source import MappedSource, open_source
+from tdconv.taskpaper import CsvToTaskPaperConverter
+from tdconv.unicode_csv import UnicodeWriter
+from tdconv.manifest import ZipManifest
+from tdconv.tdconv import (args_error, ConversionError, convert, convert_stream, FormatError, make_parser,
+                           parse_formats, process_directory, process_zip, TargetCollisionError, ZipConversionError)
 
 
 def data_dir():
@@ -65,6 +90,28 @@ class BasicConverterTests(TodoistConverterTests):
         args = Namespace(file=self.file, format='opml', output=None)
         self._run_test_and_compare_results(args, 'basic-test.opml', 'basic-test--result.opml')
 
+    def test_failed_conversion_to_opml_keeps_target(self):
+        header = b'TYPE,CONTENT,PRIORITY,INDENT,AUTHOR,RESPONSIBLE,DATE,DATE_LANG,TIMEZONE\r\n'
+        with open('broken.csv', 'wb') as f:
+            f.write(header + b'task,a,4,1,,,,en,\r\n' * 1000 + b'task,\xff\xfe,4,1,,,,en,\r\n')
+        with open('broken.opml', 'wb') as f:
+            f.write(b'earlier result')
+        args = Namespace(file='broken.csv', format='opml', output=None)
+        self.assertRaises(UnicodeDecodeError, convert, args)
+        self.assertEqual(sorted(os.listdir('.')), ['broken.csv', 'broken.opml'])
+        with open('broken.opml', 'rb') as f:
+            self.assertEqual(f.read(), b'earlier result')
+
+
+class ArgsErrorTests(unittest.TestCase):
+    def test_valid_args(self):
+        self.assertIsNone(args_error(make_parser().parse_args(['--jobs', '4', '--profile', 'report.json',
+                                                                '--profile-dump', 'dumps'])))
+
+    def test_invalid_combinations(self):
+        for argv in (['--jobs', '2', '--download'], ['--profile-dump', 'dumps']):
+            self.assertIsNotNone(args_error(make_parser().parse_args(argv)))
+
 
 class UnicodeConverterTests(TodoistConverterTests):
     def test_basic_conversion_to_csv(self):
@@ -147,3 +194,953 @@ class OuptutFileTests(TodoistConverterTests):
 
     def test_output_of_two_files_to_taskpaper(self):
         self._test_appending_output('combined-output.taskpaper', 'taskpaper', 'basic-test--result-combined.taskpaper')
+
+
+class MultiFormatTests(TodoistConverterTests):
+    def setUp(self):
+        self.file = make_path('basic-test.csv')
+        super(MultiFormatTests, self).setUp()
+
+    def test_formats_match_single_conversions(self):
+        args = Namespace(file=self.file, format='md,taskpaper,opml', download=False, output=None)
+        convert(args)
+        for ext in ('md', 'taskpaper', 'opml'):
+            self._compare_results(os.path.join(self.results, 'basic-test.' + ext),
+                                  make_path('basic-test--result.' + ext))
+
+    def test_output_is_used_as_name_root(self):
+        args = Namespace(file=self.file, format='md,taskpaper', download=False, output='special.txt')
+        convert(args)
+        self._compare_results('special.md', make_path('basic-test--result.md'))
+        self._compare_results('special.taskpaper', make_path('basic-test--result.taskpaper'))
+
+    def test_failed_finish_aborts_the_other_converters(self):
+        class FailingConverter(CsvToMarkdownConverter):
+            def finish(self):
+                super(FailingConverter, self).finish()
+                raise IOError('disk full')
+
+        args = Namespace(file=self.file, download=False, output=None)
+        with open(self.file, 'rb') as source_file:
+            group = ConverterGroup([FailingConverter(args, source_file, 'failing.md'),
+                                    CsvToOpmlConverter(args, source_file, 'aborted.opml')])
+            self.assertRaises(IOError, group.convert)
+        self.assertTrue(group.converters[1].target.closed)
+        self.assertEqual(os.listdir('.'), ['failing.md'])
+
+    def test_todoist_cannot_be_combined(self):
+        args = Namespace(file=self.file, format='md,todoist', download=False, output=None)
+        self.assertRaises(FormatError, convert, args)
+
+    def test_unknown_and_duplicate_formats_are_rejected(self):
+        for format in ('md,md', 'md,fooo', 'taskpaper, MD,md'):
+            args = Namespace(file=self.file, format=format, download=False, output=None)
+            self.assertRaises(FormatError, convert, args)
+        self.assertEqual(os.listdir(self.results), [])
+        # a single unknown format is still Markdown
+        self.assertEqual(parse_formats('fooo'), [('fooo', CsvToMarkdownConverter)])
+
+
+class ZipConverterTests(TodoistConverterTests):
+    def setUp(self):
+        super(ZipConverterTests, self).setUp()
+        for name in ('sequential', 'parallel'):
+            os.mkdir(os.path.join(self.results, name))
+            shutil.copy(make_path('zip-test.zip'), os.path.join(self.results, name))
+
+    def _convert_zip(self, name, format, jobs):
+        args = Namespace(file=os.path.join(self.results, name, 'zip-test.zip'),
+                         format=format, download=False, output=None, jobs=jobs)
+        convert(args)
+
+    def test_parallel_conversion_matches_sequential(self):
+        for format in ('md', 'taskpaper', 'opml'):
+            self._convert_zip('sequential', format, 1)
+            self._convert_zip('parallel', format, 3)
+        sequential = sorted(os.listdir(os.path.join(self.results, 'sequential')))
+        self.assertEqual(sequential, sorted(os.listdir(os.path.join(self.results, 'parallel'))))
+        self.assertEqual(len(sequential), 16)
+        for name in sequential:
+            self.compare_files(os.path.join(self.results, 'sequential', name),
+                               os.path.join(self.results, 'parallel', name))
+
+    def _write_zip(self, name, members):
+        with zipfile.ZipFile(os.path.join(self.results, name, 'zip-test.zip'), 'w') as archive:
+            for filename, data in members:
+                archive.writestr(filename, data)
+
+    def _listing(self, directory):
+        """Relative paths and contents of all files in directory."""
+        files = {}
+        for root, dirs, names in os.walk(directory):
+            for name in names:
+                path = os.path.join(root, name)
+                with open(path, 'rb') as f:
+                    files[os.path.relpath(path, directory)] = f.read()
+        return files
+
+    def _convert_members(self, name, members, jobs, download, error):
+        """Convert members in directory name, expect error, return the resulting files."""
+        shutil.rmtree(os.path.join(self.results, name))
+        os.mkdir(os.path.join(self.results, name))
+        self._write_zip(name, members)
+        os.chdir(os.path.join(self.results, name))
+        args = Namespace(file=os.path.join(self.results, name, 'zip-test.zip'),
+                         format='md', download=download, output=None, jobs=jobs)
+        with self.assertRaises(error) as raised:
+            convert(args)
+        files = self._listing(os.path.join(self.results, name))
+        del files['zip-test.zip']
+        return raised.exception, files
+
+    def test_failing_member(self):
+        server = AttachmentServer(self.results)
+        self.addCleanup(server.stop)
+        with open(os.path.join(self.results, 'file.txt'), 'wb') as f:
+            f.write(b'attachment')
+        header = b'TYPE,CONTENT,PRIORITY,INDENT,AUTHOR,RESPONSIBLE,DATE,DATE_LANG,TIMEZONE\r\n'
+        note = b'note,"[[file {""file_name"": ""file.txt"", ""file_url"": ""%s""}]]",,,,,,,\r\n'
+        members = [('a.csv', header + b'task,a,4,1,,,,en,\r\n' + note % server.url('file.txt')),
+                   ('b.csv', header + b'task,\xff\xfe,4,1,,,,en,\r\n'),
+                   ('c.csv', header + b'task,c,4,1,,,,en,\r\n' + note % server.url('file.txt?c'))]
+        # a sequential conversion stops at the first error
+        error, sequential = self._convert_members('sequential', members, 1, False, UnicodeDecodeError)
+        self.assertEqual(sorted(sequential), ['a.md', 'b.md'])
+        # in parallel, all other members are converted, with the same output
+        error, parallel = self._convert_members('parallel', members, 3, False, ZipConversionError)
+        self.assertEqual([member for member, tb in error.errors], ['b.csv'])
+        self.assertEqual(sorted(parallel), ['a.md', 'b.md', 'c.md'])
+        del parallel['c.md']
+        self.assertEqual(parallel, sequential)
+        # with download, members are converted sequentially
+        error, sequential = self._convert_members('sequential', members, 1, True, UnicodeDecodeError)
+        error, parallel = self._convert_members('parallel', members, 3, True, UnicodeDecodeError)
+        self.assertEqual(parallel, sequential)
+        self.assertEqual(sequential[os.path.join('attachments', 'file.txt')], b'attachment')
+
+    def test_colliding_members(self):
+        csv = b'TYPE,CONTENT,PRIORITY,INDENT\r\ntask,a task,4,1\r\n'
+        self._write_zip('parallel', [('x/dup.csv', csv), ('y/dup.csv', csv)])
+        args = Namespace(file=os.path.join(self.results, 'parallel', 'zip-test.zip'),
+                         format='md', download=False, output=None, jobs=3)
+        self.assertRaises(TargetCollisionError, convert, args)
+        self.assertEqual(os.listdir(os.path.join(self.results, 'parallel')), ['zip-test.zip'])
+        # sequentially, both are appended to the same target
+        args.jobs = 1
+        convert(args)
+        with open(os.path.join(self.results, 'parallel', 'dup.md')) as f:
+            self.assertEqual(f.read().count('## a task'), 2)
+
+
+class IncrementalZipTests(TodoistConverterTests):
+    def setUp(self):
+        super(IncrementalZipTests, self).setUp()
+        self.zip = os.path.join(self.results, 'zip-test.zip')
+        shutil.copy(make_path('zip-test.zip'), self.zip)
+
+    def _convert(self, jobs=1, format='taskpaper'):
+        args = Namespace(file=self.zip, format=format, download=False, output=None, jobs=jobs, incremental=True)
+        return process_zip(parse_formats(format), args)
+
+    def _outputs(self):
+        outputs = {}
+        for name in os.listdir(self.results):
+            if name.endswith('.taskpaper'):
+                with open(name, 'rb') as f:
+                    outputs[name] = f.read()
+        return outputs
+
+    def test_unchanged_members_are_skipped(self):
+        for jobs in (1, 3):
+            first = self._convert(jobs)
+            self.assertEqual((first.converted, first.skipped), (5, 0))
+            outputs = self._outputs()
+            second = self._convert(jobs)
+            self.assertEqual((second.converted, second.skipped), (0, 5))
+            self.assertEqual(self._outputs(), outputs)
+            os.remove(ZipManifest.FILENAME)
+
+    def test_changed_member_is_converted_again(self):
+        self._convert()
+        outputs = self._outputs()
+        with zipfile.ZipFile(self.zip) as archive:
+            members = [(info.filename, archive.read(info)) for info in archive.infolist()]
+        changed = [name for name, data in members if name.endswith('.csv')][0]
+        with zipfile.ZipFile(self.zip, 'w') as archive:
+            for name, data in members:
+                if name == changed:
+                    data = data.replace('project task', 'project changed task')
+                archive.writestr(name, data)
+        summary = self._convert()
+        self.assertEqual((summary.converted, summary.skipped), (1, 4))
+        changed_output = os.path.splitext(os.path.basename(changed))[0] + '.taskpaper'
+        for name, contents in self._outputs().items():
+            if name == changed_output:
+                self.assertIn('project changed task', contents)
+                self.assertEqual(contents, outputs[name].replace('project task', 'project changed task'))
+            else:
+                self.assertEqual(contents, outputs[name])
+
+    def test_removed_target_is_converted_again(self):
+        self._convert()
+        os.remove(sorted(self._outputs())[0])
+        summary = self._convert()
+        self.assertEqual((summary.converted, summary.skipped), (1, 4))
+
+
+class DirectoryConverterTests(TodoistConverterTests):
+    SOURCES = ('basic-test.csv', 'unicode-and-quotes.csv', 'basic-opml-test.opml')
+
+    def setUp(self):
+        super(DirectoryConverterTests, self).setUp()
+        self.directory = os.path.join(self.results, 'backup')
+        os.mkdir(self.directory)
+        for name in self.SOURCES:
+            shutil.copy(make_path(name), self.directory)
+
+    def _convert(self, format, jobs):
+        args = Namespace(file=self.directory, format=format, download=False, output=None, jobs=jobs)
+        return process_directory(parse_formats(format), args)
+
+    def test_files_are_converted_in_parallel(self):
+        for jobs in (1, 3):
+            summary = self._convert('md', jobs)
+            self.assertEqual((summary.converted, summary.failed), (2, 0))
+            for name in ('basic-test', 'unicode-and-quotes'):
+                self._compare_results(os.path.join(self.directory, name + '.md'),
+                                      make_path(name + '--result.md'))
+
+    def test_download_converts_one_file_after_the_other(self):
+        server = AttachmentServer(self.results)
+        self.addCleanup(server.stop)
+        with open(os.path.join(self.results, 'file.txt'), 'wb') as f:
+            f.write(b'attachment')
+        note = b'note,"[[file {""file_name"": ""file.txt"", ""file_url"": ""%s""}]]"\r\n'
+        # the fixtures link to attachments on the internet
+        for name in self.SOURCES:
+            os.remove(os.path.join(self.directory, name))
+        for name in ('a', 'b', 'c'):
+            with open(os.path.join(self.directory, name + '.csv'), 'wb') as f:
+                f.write(b'TYPE,CONTENT,PRIORITY,INDENT\r\ntask,%s,4,1\r\n' % name.encode('ascii'))
+                f.write(note % server.url('file.txt?' + name))
+        os.chdir(self.directory)
+        args = Namespace(file=self.directory, format='md', download=True, output=None, jobs=3)
+        self.assertEqual(process_directory(parse_formats('md'), args).converted, 3)
+        # attachments are named in file order
+        for name, attachment in (('a', 'file.txt'), ('b', 'file(2).txt'), ('c', 'file(3).txt')):
+            with open(name + '.md') as f:
+                self.assertIn('(attachments/%s)' % attachment, f.read())
+
+    def test_todoist_converts_opml_files(self):
+        summary = self._convert('todoist', 2)
+        self.assertEqual(summary.converted, 1)
+        self._compare_results(os.path.join(self.directory, 'basic-opml-test.csv'),
+                              make_path('basic-opml-test--result.csv'))
+
+    def test_errors_are_aggregated(self):
+        with open(os.path.join(self.directory, 'broken.csv'), 'wb') as f:
+            f.write(b'TYPE,CONTENT,PRIORITY,INDENT\ntask,\xff\xfe,4,1\n')
+        for jobs in (1, 3):
+            args = Namespace(file=self.directory, format='taskpaper', download=False, output=None, jobs=jobs)
+            with self.assertRaises(ConversionError) as raised:
+                convert(args)
+            self.assertEqual([os.path.basename(name) for name, tb in raised.exception.errors], ['broken.csv'])
+            self.assertIn('UnicodeDecodeError', raised.exception.errors[0][1])
+            self._compare_results(os.path.join(self.directory, 'basic-test.taskpaper'),
+                                  make_path('basic-test--result.taskpaper'))
+
+
+class StreamConversionTests(TodoistConverterTests):
+    def _read(self, name):
+        with open(make_path(name), 'rb') as f:
+            return f.read()
+
+    def test_bytes_to_bytes(self):
+        for format in ('md', 'taskpaper', 'opml'):
+            result = convert_stream(self._read('basic-test.csv'), format=format, name='basic-test.csv')
+            self.assertEqual(result, self._read('basic-test--result.' + format))
+        self.assertEqual(os.listdir(self.results), [])
+
+    def test_file_objects(self):
+        target = io.BytesIO()
+        with open(make_path('basic-opml-test.opml'), 'rb') as source:
+            self.assertIsNone(convert_stream(source, target, format='todoist'))
+        # the target is left open
+        self.assertEqual(target.getvalue(), self._read('basic-opml-test--result.csv'))
+        self.assertEqual(os.listdir(self.results), [])
+
+    def test_single_format(self):
+        self.assertRaises(FormatError, convert_stream, b'', format='md,opml')
+
+
+class ConversionServerTests(TodoistConverterTests):
+    def setUp(self):
+        super(ConversionServerTests, self).setUp()
+        self.server = ConversionServer()
+
+    def _request(self, id, name, format):
+        return dict(id=id, file=make_path(name), cwd=self.results, options=dict(format=format))
+
+    def test_requests_are_answered_in_order(self):
+        requests = [self._request(1, 'basic-test.csv', 'taskpaper'),
+                    self._request(2, 'basic-opml-test.opml', 'todoist')]
+        lines = b''.join(json.dumps(request).encode('utf-8') + b'\n' for request in requests)
+        responses = io.BytesIO()
+        self.server.serve(io.BytesIO(lines + b'no json\n'), responses)
+        responses = [json.loads(line) for line in responses.getvalue().splitlines()]
+        self.assertEqual([(r['id'], r['ok']) for r in responses], [(1, True), (2, True), (None, False)])
+        self._compare_results('basic-test.taskpaper', make_path('basic-test--result.taskpaper'))
+        self._compare_results('basic-opml-test.csv', make_path('basic-opml-test--result.csv'))
+
+    def test_errors_are_reported(self):
+        missing, = self.server.handle(json.dumps(self._request(1, 'missing.csv', 'md')))
+        self.assertFalse(missing['ok'])
+        self.assertIn('IOError', missing['error'])
+        request = self._request(2, 'basic-test.csv', 'md')
+        request['options']['no_such_option'] = True
+        unknown, = self.server.handle(json.dumps(request))
+        self.assertEqual(unknown['error'], 'ValueError: unknown option(s): no_such_option')
+
+    def test_options_are_validated(self):
+        for options in (dict(jobs='4'), dict(download='yes'), dict(format=None), dict(verbose=True),
+                        dict(jobs=2, download=True)):
+            request = self._request(1, 'basic-test.csv', 'md')
+            request['options'].update(options)
+            response, = self.server.handle(json.dumps(request))
+            self.assertFalse(response['ok'])
+            self.assertTrue(response['error'].startswith('ValueError: '))
+        self.assertEqual(os.listdir(self.results), [])
+
+    def test_command_line_requests(self):
+        request = dict(id=1, argv=['-f', 'taskpaper', make_path('basic-test.csv'), make_path('unicode-and-quotes.csv')],
+                       cwd=self.results)
+        responses = self.server.handle(json.dumps(request))
+        self.assertEqual([(r['id'], r['ok']) for r in responses], [(1, True), (1, True)])
+        self._compare_results('basic-test.taskpaper', make_path('basic-test--result.taskpaper'))
+        for argv in (['-f', 'md'], ['--jobs', 'x', 'a.csv'], ['--no-such-option', 'a.csv'], 'a.csv'):
+            response, = self.server.handle(json.dumps(dict(id=2, argv=argv)))
+            self.assertFalse(response['ok'])
+            self.assertTrue(response['error'].startswith('invalid arguments: '))
+
+    def test_submit_to_socket(self):
+        path = os.path.join(self.results, 'tdconv.sock')
+        socket_server = self.server.make_socket_server(path)
+        thread = threading.Thread(target=socket_server.serve_forever)
+        thread.start()
+        try:
+            requests = [self._request(i, 'basic-test.csv', format) for i, format in enumerate(('md', 'opml'))]
+            responses = list(submit(path, requests))
+        finally:
+            socket_server.shutdown()
+            socket_server.server_close()
+            thread.join()
+        self.assertEqual([(r['id'], r['ok']) for r in responses], [(0, True), (1, True)])
+        self._compare_results('basic-test.md', make_path('basic-test--result.md'))
+        self._compare_results('basic-test.opml', make_path('basic-test--result.opml'))
+
+
+class OpmlToCsvTests(TodoistConverterTests):
+    def test_outline_deeper_than_recursion_limit(self):
+        depth = 3000
+        with open('deep.opml', 'w') as f:
+            f.write('<?xml version="1.0"?><opml version="1.0"><head><title>deep</title></head><body>')
+            for i in range(depth):
+                f.write('<outline text="level %s" _note="note">' % (i + 1))
+            f.write('</outline>' * depth)
+            f.write('<outline text="last" /></body></opml>')
+        convert(Namespace(file='deep.opml', format='todoist', output=None))
+        with open('deep.csv') as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1 + depth * 3 + 2)
+        self.assertEqual(lines[-5:], ['task,level %s,,%s,,,,,' % (depth, depth), 'note,note,,,,,,,', ',,,,,,,,',
+                                      'task,last,,1,,,,,', ',,,,,,,,'])
+
+
+class CsvToOpmlTests(TodoistConverterTests):
+    def test_task_with_many_notes(self):
+        lines = ['TYPE,CONTENT,PRIORITY,INDENT,AUTHOR,RESPONSIBLE,DATE,DATE_LANG,TIMEZONE',
+                 'task,support ticket,4,1,,,,en,']
+        lines.extend('note,comment %s,,,,,,,' % i for i in range(10000))
+        lines.append('task,next,4,1,,,,en,')
+        with open('many-notes.csv', 'w') as f:
+            f.write('\r\n'.join(lines))
+        convert(Namespace(file='many-notes.csv', format='opml', output=None))
+        body = ET.parse('many-notes.opml').getroot().find('body')
+        first, second = body.findall('outline')
+        self.assertEqual(first.get('_note'), '\n\n'.join('comment %s' % i for i in range(10000)))
+        self.assertIsNone(second.get('_note'))
+
+
+class OpmlWriterTests(unittest.TestCase):
+    OUTLINES = [(1, u'a & b <c> "d"', u'line 1\nline 2\t\r & <x>'),
+                (2, u'\xfcml\xe4ut \u201cquoted\u201d \U0001F600', None),
+                (3, u'deep', u'n'),
+                (3, u'deep sibling', None),
+                (1, u'second', None),
+                (2, u'child', u'\u2603'),
+                (1, u'', None)]
+
+    def _element_tree(self, title, outlines):
+        opml = ET.Element('opml', version='1.0')
+        head = ET.SubElement(opml, 'head')
+        ET.SubElement(head, 'title').text = title
+        ET.SubElement(head, 'expansionState').text = '0,1'
+        parents = {0: ET.SubElement(opml, 'body')}
+        for level, text, note in outlines:
+            parents[level] = ET.SubElement(parents[level - 1], 'outline', text=text)
+            if note:
+                parents[level].set('_note', note)
+        result = io.BytesIO()
+        ET.ElementTree(opml).write(result, encoding='UTF-8', xml_declaration=True)
+        return result.getvalue()
+
+    def _opml_writer(self, title, outlines):
+        result = io.BytesIO()
+        writer = OpmlWriter(result, title)
+        for level, text, note in outlines:
+            attributes = writer.start_outline(level, text)
+            if note:
+                attributes['_note'] = note
+        writer.close()
+        return result.getvalue()
+
+    def test_output_matches_element_tree(self):
+        for title, outlines in ((u'T\xeftle & <more>', self.OUTLINES), (u'', self.OUTLINES[:1]), (u'empty', [])):
+            self.assertEqual(self._opml_writer(title, outlines), self._element_tree(title, outlines))
+
+
+class AttachmentServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Local HTTP/1.1 server that serves files from a directory and counts connections and requests."""
+    daemon_threads = True
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.connections = 0
+        self.requests = 0
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), AttachmentRequestHandler)
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def url(self, name):
+        return 'http://127.0.0.1:%s/%s' % (self.server_address[1], name)
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class AttachmentRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        SimpleHTTPServer.SimpleHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def translate_path(self, path):
+        self.server.requests += 1
+        # as a proxy, the server gets absolute URLs
+        return os.path.join(self.server.directory, urlparse.urlsplit(path).path.lstrip('/'))
+
+    def log_message(self, *args):
+        pass
+
+
+class AttachmentDownloadTests(TodoistConverterTests):
+    def setUp(self):
+        super(AttachmentDownloadTests, self).setUp()
+        self.files = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.files)
+        self.server = AttachmentServer(self.files)
+        self.addCleanup(self.server.stop)
+
+    def _make_attachment(self, name, contents):
+        with open(os.path.join(self.files, name), 'wb') as f:
+            f.write(contents)
+        return json.dumps({'file_name': name, 'file_url': self.server.url(name)})
+
+    def _write_project(self, attachments):
+        """Write a CSV with one task and a note for each attachment."""
+        lines = ['TYPE,CONTENT,PRIORITY,INDENT,AUTHOR,RESPONSIBLE,DATE,DATE_LANG,TIMEZONE',
+                 'task,a task,4,1,,,,en,']
+        for attachment in attachments:
+            lines.append('note,"[[file %s]]",,,,,,,' % attachment.replace('"', '""'))
+        path = os.path.join(self.results, 'attachments-test.csv')
+        with open(path, 'wb') as f:
+            f.write('\r\n'.join(lines))
+        return path
+
+    def test_parallel_download_to_md(self):
+        attachments = [self._make_attachment('file-%s.txt' % i, 'contents %s' % i) for i in range(10)]
+        attachments.append(self._make_attachment('file-0.txt', 'contents 0'))
+        args = Namespace(file=self._write_project(attachments), format='md', download=True,
+                         output=None, download_threads=3)
+        convert(args)
+        with open('attachments-test.md') as f:
+            md = f.read()
+        for i in range(10):
+            self.assertIn('[file-%s.txt](attachments/file-%s.txt)' % (i, i), md)
+            with open(os.path.join('attachments', 'file-%s.txt' % i)) as f:
+                self.assertEqual(f.read(), 'contents %s' % i)
+        # files are created with the usual permissions, not the private ones of temporary files
+        umask = os.umask(0)
+        os.umask(umask)
+        self.assertEqual(stat.S_IMODE(os.stat('attachments/file-1.txt').st_mode), 0o666 & ~umask)
+        # the repeated URL is downloaded once, to the same file
+        self.assertEqual(md.count('[file-0.txt](attachments/file-0.txt)'), 2)
+        self.assertEqual(sorted(os.listdir('attachments')), sorted('file-%s.txt' % i for i in range(10)))
+        self.assertEqual(self.server.requests, 10)
+        self.assertLessEqual(self.server.connections, 3)
+
+    def test_download_buffer_is_capped(self):
+        contents = os.urandom(300 * 1024)
+        attachments = [self._make_attachment('large-%s.bin' % i, contents) for i in range(4)]
+        source = self._write_project(attachments)
+        args = Namespace(file=source, format='md', download=True, output=None,
+                         download_threads=2, download_buffer=64 * 1024)
+        with open(source) as source_file:
+            converter = CsvToMarkdownConverter(args, source_file)
+            converter.convert()
+        self.assertGreater(converter.downloader.peak_buffered, 0)
+        self.assertLessEqual(converter.downloader.peak_buffered, 64 * 1024)
+        for i in range(4):
+            with open(os.path.join('attachments', 'large-%s.bin' % i), 'rb') as f:
+                self.assertEqual(f.read(), contents)
+        self.assertEqual(sorted(os.listdir('attachments')), ['large-%s.bin' % i for i in range(4)])
+
+    def test_threads_are_limited_by_download_buffer(self):
+        contents = os.urandom(100 * 1024)
+        attachments = [self._make_attachment('large-%s.bin' % i, contents) for i in range(8)]
+        source = self._write_project(attachments)
+        args = Namespace(file=source, format='md', download=True, output=None,
+                         download_threads=32, download_buffer=64 * 1024)
+        with open(source) as source_file:
+            converter = CsvToMarkdownConverter(args, source_file)
+            converter.convert()
+        self.assertEqual(converter.downloader.thread_count, 16)
+        self.assertLessEqual(converter.downloader.peak_buffered, 64 * 1024)
+        for i in range(8):
+            with open(os.path.join('attachments', 'large-%s.bin' % i), 'rb') as f:
+                self.assertEqual(f.read(), contents)
+
+    def test_cached_attachments_are_not_downloaded_again(self):
+        attachments = [self._make_attachment('file-%s.txt' % i, 'contents') for i in range(3)]
+        cache = os.path.join(self.results, 'cache')
+        args = Namespace(file=self._write_project(attachments), format='taskpaper', download=True,
+                         output=None, cache=cache)
+        convert(args)
+        self.assertGreater(self.server.connections, 0)
+        # identical contents are stored once and linked
+        self.assertEqual(len(os.listdir(os.path.join(cache, 'objects'))), 1)
+        inodes = set(os.stat(os.path.join('attachments', 'file-%s.txt' % i)).st_ino for i in range(3))
+        self.assertEqual(len(inodes), 1)
+
+        shutil.rmtree('attachments')
+        os.remove('attachments-test.taskpaper')
+        self.server.connections = 0
+        convert(args)
+        self.assertEqual(self.server.connections, 0)
+        for i in range(3):
+            with open(os.path.join('attachments', 'file-%s.txt' % i)) as f:
+                self.assertEqual(f.read(), 'contents')
+
+    def test_cached_attachments_are_reused_in_place(self):
+        attachments = [self._make_attachment('file-%s.txt' % i, 'contents %s' % i) for i in range(2)]
+        cache = os.path.join(self.results, 'cache')
+        args = Namespace(file=self._write_project(attachments), format='taskpaper', download=True,
+                         output=None, cache=cache)
+        convert(args)
+        # converting again keeps the attachments of the first run
+        self.server.connections = 0
+        convert(args)
+        self.assertEqual(self.server.connections, 0)
+        self.assertEqual(sorted(os.listdir('attachments')), ['file-0.txt', 'file-1.txt'])
+
+        # an attachment edited in place (and the cached file linked to it) isn't used
+        with open(os.path.join('attachments', 'file-0.txt'), 'w') as f:
+            f.write('edited')
+        convert(args)
+        self.assertGreater(self.server.connections, 0)
+        self.assertEqual(sorted(os.listdir('attachments')), ['file-0(2).txt', 'file-0.txt', 'file-1.txt'])
+        with open(os.path.join('attachments', 'file-0(2).txt')) as f:
+            self.assertEqual(f.read(), 'contents 0')
+
+    def test_formats_share_downloads(self):
+        attachments = [self._make_attachment('file-%s.txt' % i, 'contents %s' % i) for i in range(3)]
+        args = Namespace(file=self._write_project(attachments), format='md,taskpaper', download=True,
+                         output=None)
+        convert(args)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(sorted(os.listdir('attachments')), ['file-%s.txt' % i for i in range(3)])
+        with open('attachments-test.md') as f:
+            md = f.read()
+        with open('attachments-test.taskpaper') as f:
+            taskpaper = f.read()
+        for i in range(3):
+            self.assertIn('(attachments/file-%s.txt)' % i, md)
+            self.assertIn('attachments/file-%s.txt' % i, taskpaper)
+
+    def test_downloads_are_profiled(self):
+        attachments = [self._make_attachment('file-%s.txt' % i, 'x' * 100) for i in range(3)]
+        args = Namespace(file=self._write_project(attachments), format='md', download=True,
+                         output=None, profile='report.json')
+        convert(args)
+        with open('report.json') as f:
+            report = json.load(f)['inputs'][0]
+        self.assertIn('download', report['seconds'])
+        self.assertEqual((report['counters']['downloads'], report['counters']['bytes_downloaded']), (3, 300))
+
+    def test_failed_download_raises(self):
+        attachment = json.dumps({'file_name': 'missing.txt', 'file_url': self.server.url('missing.txt')})
+        args = Namespace(file=self._write_project([attachment]), format='taskpaper', download=True,
+                         output=None)
+        self.assertRaises(Exception, convert, args)
+        # the reserved name is released
+        self.assertEqual(os.listdir('attachments'), [])
+
+    def test_downloads_use_proxy(self):
+        environ = dict(os.environ)
+        self.addCleanup(os.environ.update, environ)
+        self.addCleanup(os.environ.clear)
+        for name in ('no_proxy', 'NO_PROXY'):
+            os.environ.pop(name, None)
+        os.environ['http_proxy'] = self.server.url('')
+        self._make_attachment('file.txt', 'contents')
+        attachment = json.dumps({'file_name': 'file.txt', 'file_url': 'http://attachments.invalid/file.txt'})
+        args = Namespace(file=self._write_project([attachment]), format='md', download=True, output=None)
+        convert(args)
+        with open(os.path.join('attachments', 'file.txt')) as f:
+            self.assertEqual(f.read(), 'contents')
+
+
+class OutlineCacheTests(TodoistConverterTests):
+    def setUp(self):
+        super(OutlineCacheTests, self).setUp()
+        self.cache = os.path.join(self.results, 'outline-cache')
+        shutil.copy(make_path('full-todoist-project.csv'), self.results)
+        shutil.copy(make_path('unicode-opml.opml'), self.results)
+
+    def _convert(self, klass, source, **kwargs):
+        args = Namespace(file=source, download=False, output=None, outline_cache=self.cache, **kwargs)
+        with codecs.open(source, 'r') as source_file:
+            converter = klass(args, source_file)
+            converter.convert()
+        return converter.outline_cache
+
+    def test_unchanged_csv_is_replayed(self):
+        self.assertEqual(self._convert(CsvToTaskPaperConverter, 'full-todoist-project.csv').misses, 1)
+        os.rename('full-todoist-project.taskpaper', 'first.taskpaper')
+        self.assertEqual(self._convert(CsvToTaskPaperConverter, 'full-todoist-project.csv').hits, 1)
+        self._compare_results('full-todoist-project.taskpaper', make_path('full-todoist-project--result.taskpaper'))
+        self._compare_results('first.taskpaper', make_path('full-todoist-project--result.taskpaper'))
+
+    def test_unchanged_opml_is_replayed(self):
+        self.assertEqual(self._convert(OpmlToCsvConverter, 'unicode-opml.opml').misses, 1)
+        os.remove('unicode-opml.csv')
+        self.assertEqual(self._convert(OpmlToCsvConverter, 'unicode-opml.opml').hits, 1)
+        self._compare_results('unicode-opml.csv', make_path('unicode-opml--result.csv'))
+
+    def test_changed_source_is_parsed(self):
+        self._convert(CsvToMarkdownConverter, 'full-todoist-project.csv')
+        with open('full-todoist-project.csv', 'ab') as f:
+            f.write('\r\ntask,one more task,4,1,,,,en,\r\n')
+        os.remove('full-todoist-project.md')
+        self.assertEqual(self._convert(CsvToMarkdownConverter, 'full-todoist-project.csv').misses, 1)
+        with open('full-todoist-project.md') as f:
+            self.assertIn('one more task', f.read())
+
+    def test_invalidate(self):
+        self._convert(CsvToMarkdownConverter, 'full-todoist-project.csv')
+        self._convert(OpmlToCsvConverter, 'unicode-opml.opml')
+        self.assertEqual(len(os.listdir(self.cache)), 2)
+        OutlineCache(self.cache).invalidate('full-todoist-project.csv')
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+        OutlineCache(self.cache).invalidate()
+        self.assertEqual(os.listdir(self.cache), [])
+
+    def test_size_is_bounded(self):
+        self._convert(CsvToMarkdownConverter, 'full-todoist-project.csv')
+        size = os.path.getsize(os.path.join(self.cache, os.listdir(self.cache)[0]))
+        # the older entry is evicted
+        self._convert(OpmlToCsvConverter, 'unicode-opml.opml', outline_cache_size=size)
+        self.assertEqual(len(os.listdir(self.cache)), 1)
+        self.assertEqual(self._convert(OpmlToCsvConverter, 'unicode-opml.opml').hits, 1)
+
+    def test_items_are_streamed(self):
+        parsed = []
+
+        def parse():
+            for i in range(2500):
+                parsed.append(i)
+                yield (b'task', b'%d' % i)
+
+        cache = OutlineCache(self.cache)
+        with open('full-todoist-project.csv', 'rb') as source_file:
+            items = cache.get(source_file, 'csv', parse)
+            next(items)
+            self.assertEqual(parsed, [0])
+            # a stream that isn't consumed completely isn't stored
+            items.close()
+            self.assertEqual(os.listdir(self.cache), [])
+            self.assertEqual(len(list(cache.get(source_file, 'csv', parse))), 2500)
+            replayed = cache.get(source_file, 'csv', parse)
+            self.assertEqual(cache.hits, 1)
+            self.assertEqual(list(replayed), [(b'task', b'%d' % i) for i in range(2500)])
+
+
+class MappedSourceTests(TodoistConverterTests):
+    def test_lines_match_file(self):
+        path = make_path('full-todoist-project.csv')
+        with open(path, 'rb') as f:
+            lines = list(f)
+        with MappedSource(path) as source:
+            self.assertEqual(list(source), lines)
+        # a last line without \n
+        with open('unterminated.csv', 'wb') as f:
+            f.write(b'task,a\r\ntask,b')
+        with MappedSource('unterminated.csv') as source:
+            self.assertEqual(list(source), [b'task,a\r\n', b'task,b'])
+
+    def test_conversion(self):
+        for source, format, output, result in (
+                ('full-todoist-project.csv', 'md', 'full-todoist-project.md', 'full-todoist-project--result.md'),
+                ('unicode-opml.opml', 'todoist', 'unicode-opml.csv', 'unicode-opml--result.csv')):
+            args = Namespace(file=make_path(source), format=format, download=False, output=None, mmap=True)
+            self._run_test_and_compare_results(args, output, result)
+
+    def test_empty_file_is_not_mapped(self):
+        open('empty.csv', 'w').close()
+        with open_source('empty.csv', mapped=True) as source:
+            self.assertNotIsInstance(source, MappedSource)
+            self.assertEqual(list(source), [])
+
+
+class ProfileTests(TodoistConverterTests):
+    def _report(self):
+        with open('report.json') as f:
+            return json.load(f)['inputs']
+
+    def test_stages_and_counters(self):
+        source = make_path('full-todoist-project.csv')
+        args = Namespace(file=source, format='md', download=False, output=None, profile='report.json')
+        self._run_test_and_compare_results(args, 'full-todoist-project.md', 'full-todoist-project--result.md')
+        report, = self._report()
+        self.assertEqual(report['input'], source)
+        self.assertEqual(set(report['seconds']), set(['read', 'notes', 'render', 'write', 'finish']))
+        counters = report['counters']
+        self.assertEqual((counters['rows'], counters['tasks'], counters['notes'], counters['attachments']),
+                         (17, 8, 9, 3))
+        self.assertEqual(counters['bytes_in'], os.path.getsize(source))
+        self.assertEqual(counters['bytes_out'], os.path.getsize('full-todoist-project.md'))
+
+    def test_formats_count_rows_once(self):
+        args = Namespace(file=make_path('full-todoist-project.csv'), format='md,taskpaper', download=False,
+                         output=None, profile='report.json')
+        convert(args)
+        counters = self._report()[0]['counters']
+        self.assertEqual((counters['rows'], counters['tasks'], counters['notes']), (17, 8, 9))
+        self.assertEqual(counters['bytes_out'], os.path.getsize('full-todoist-project.md') +
+                         os.path.getsize('full-todoist-project.taskpaper'))
+
+    def test_opml_to_csv(self):
+        args = Namespace(file=make_path('unicode-opml.opml'), format='todoist', output=None, profile='report.json')
+        self._run_test_and_compare_results(args, 'unicode-opml.csv', 'unicode-opml--result.csv')
+        counters = self._report()[0]['counters']
+        self.assertGreater(counters['tasks'], 0)
+        self.assertEqual(counters['bytes_out'], os.path.getsize('unicode-opml.csv'))
+
+    def test_zip_members_are_reported_and_dumped(self):
+        shutil.copy(make_path('zip-test.zip'), self.results)
+        args = Namespace(file=os.path.join(self.results, 'zip-test.zip'), format='taskpaper', download=False,
+                         output=None, jobs=2, profile='report.json', profile_dump='profiles')
+        convert(args)
+        inputs = [report['input'] for report in self._report()]
+        self.assertEqual(len(inputs), 5)
+        self.assertEqual(sorted(os.listdir('profiles')), sorted(os.path.basename(name) + '.prof' for name in inputs))
+
+
+class ProgressTests(TodoistConverterTests):
+    def test_files_and_rows_are_counted(self):
+        progress = Progress()
+        progress.add_files(1)
+        convert(Namespace(file=make_path('full-todoist-project.csv'), format='md', download=False, output=None,
+                          progress=progress))
+        self.assertEqual((progress.files_done, progress.files_total, progress.rows), (1, 1, 17))
+
+    def test_cancel_stops_at_checkpoint(self):
+        with open('large.csv', 'wb') as f:
+            f.write('TYPE,CONTENT,PRIORITY,INDENT,AUTHOR,RESPONSIBLE,DATE,DATE_LANG,TIMEZONE\r\n')
+            for i in range(Progress.ROWS * 3):
+                f.write('task,task %s,4,1,,,,en,\r\n' % i)
+        progress = Progress()
+        progress.cancel()
+        args = Namespace(file='large.csv', format='taskpaper', download=False, output=None, progress=progress)
+        self.assertRaises(ConversionCancelled, convert, args)
+        self.assertEqual(progress.rows, Progress.ROWS)
+
+    def test_cancel_zip_between_members(self):
+        shutil.copy(make_path('zip-test.zip'), self.results)
+
+        def cancel_after_first_file(progress):
+            if progress.files_done:
+                progress.cancel()
+        progress = Progress(cancel_after_first_file)
+        args = Namespace(file=os.path.join(self.results, 'zip-test.zip'), format='taskpaper', download=False,
+                         output=None, progress=progress)
+        self.assertRaises(ConversionCancelled, convert, args)
+        self.assertEqual((progress.files_done, progress.files_total), (1, 5))
+        self.assertEqual(len([name for name in os.listdir(self.results) if name.endswith('.taskpaper')]), 1)
+
+    def test_parallel_zip_members_are_counted(self):
+        shutil.copy(make_path('zip-test.zip'), self.results)
+        progress = Progress()
+        convert(Namespace(file=os.path.join(self.results, 'zip-test.zip'), format='taskpaper', download=False,
+                          output=None, jobs=2, progress=progress))
+        self.assertEqual((progress.files_done, progress.files_total), (5, 5))
+
+
+class FilenameAllocatorTests(TodoistConverterTests):
+    def test_allocate_skips_existing_files(self):
+        os.mkdir('attachments')
+        for name in ('image.png', 'image(2).png'):
+            open(os.path.join('attachments', name), 'w').close()
+        allocator = FilenameAllocator('attachments')
+        self.assertEqual(allocator.allocate('image.png'), os.path.join('attachments', 'image(3).png'))
+        self.assertEqual(allocator.allocate('image.png'), os.path.join('attachments', 'image(4).png'))
+        self.assertEqual(allocator.allocate('other.png'), os.path.join('attachments', 'other.png'))
+
+    def test_concurrent_allocators_never_share_a_name(self):
+        allocators = [FilenameAllocator('attachments') for i in range(4)]
+        paths = []
+
+        def allocate(allocator):
+            for i in range(50):
+                paths.append(allocator.allocate('image.png'))
+
+        threads = [threading.Thread(target=allocate, args=(a,)) for a in allocators]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(set(paths)), 200)
+        self.assertEqual(len(os.listdir('attachments')), 200)
+
+
+class NoteTests(unittest.TestCase):
+    def test_plain_note(self):
+        note = Note(u'just text, [no] [[attachment]]')
+        self.assertEqual(note.text, u'just text, [no] [[attachment]]')
+        self.assertIsNone(note.attachment)
+
+    def test_note_with_attachment(self):
+        note = Note(u' some text [[file {"file_name": "a]]b.png", "file_url": "https://x/a]]b.png"}]] ignored')
+        self.assertEqual(note.text, u'some text')
+        self.assertEqual((note.attachment.name, note.attachment.url), (u'a]]b.png', u'https://x/a]]b.png'))
+
+    def test_content_is_parsed_on_access(self):
+        note = Note(u'[[file {broken json]]')
+        self.assertRaises(ValueError, getattr, note, 'text')
+
+    def test_multiline_text_before_attachment_is_not_parsed(self):
+        content = u'line 1\nline 2 [[file {"file_name": "a.png", "file_url": "https://x/a.png"}]]'
+        note = Note(content)
+        self.assertEqual(note.text, content)
+        self.assertIsNone(note.attachment)
+
+    def test_multiline_attachment_is_not_parsed(self):
+        content = u'text [[file {"file_name": "a.png",\n "file_url": "https://x/a.png"}]]'
+        self.assertIsNone(Note._scan(content))
+        self.assertIsNone(Note._match(content))
+        note = Note(content)
+        self.assertEqual(note.text, content)
+        self.assertIsNone(note.attachment)
+
+    def test_parsed_notes_are_bounded_by_size(self):
+        cache = ParsedNotes(max_size=40)
+        for i in range(3):
+            cache.put(ParsedNotes.key(u'note %s' % i), (u'text', u'name', u'url %s' % i))
+        cache.get(ParsedNotes.key(u'note 0'))
+        cache.put(ParsedNotes.key(u'note 3'), (u'text', u'name', u'url 3'))
+        self.assertLessEqual(cache.size, 40)
+        # the least recently used note is evicted
+        self.assertIsNotNone(cache.get(ParsedNotes.key(u'note 0')))
+        self.assertIsNone(cache.get(ParsedNotes.key(u'note 1')))
+
+
+class TaskCollector(Converter):
+    ROW_TYPES = (Converter.TYPE_TASK,)
+
+    def convert(self):
+        self.tasks = []
+        super(TaskCollector, self).convert()
+
+    def process_task(self, row):
+        self.tasks.append(row.content)
+
+
+class RowTypesTests(unittest.TestCase):
+    def test_notes_are_skipped(self):
+        args = Namespace(file=make_path('full-todoist-project.csv'))
+        with open(args.file) as source_file:
+            converter = TaskCollector(args, source_file, 'unused')
+            converter.convert()
+        self.assertEqual(len(converter.tasks), 8)
+        self.assertEqual(converter.tasks[0], u'* unclickable task')
+
+
+class RowTests(unittest.TestCase):
+    def test_fields_are_decoded(self):
+        row = Row(['task', u'\xfcml\xe4ut'.encode('utf-8'), '4', '1', 'Bernhard', '', '2019-01-01', 'en', 'UTC'])
+        self.assertEqual((row.type, row.content, row.indent, row.timezone), (u'task', u'\xfcml\xe4ut', u'1', u'UTC'))
+        self.assertIsInstance(row.content, unicode)
+        self.assertFalse(hasattr(row, '__dict__'))
+
+    def test_missing_fields_are_empty(self):
+        row = Row._make(['note', 'text'])
+        self.assertEqual((row.content, row.date), (u'text', u''))
+
+    def test_fields_are_decoded_once(self):
+        row = Row(['task', 'content'])
+        self.assertIs(row.content, row.content)
+        self.assertIs(row.date, row.date)
+
+    def test_rows_are_read_with_bom_and_encoding(self):
+        data = codecs.BOM_UTF8 + u'task,first\r\ntask,"\u201cquoted\u201d, \xfcml\xe4ut",4,1\r\n\r\n'.encode('utf-8')
+        rows = list(Converter(Namespace(file='rows.csv'), io.BytesIO(data), 'unused').rows())
+        self.assertEqual([(row.type, row.content, row.indent) for row in rows],
+                         [(u'task', u'first', u''), (u'task', u'\u201cquoted\u201d, \xfcml\xe4ut', u'1')])
+
+
+class UnicodeWriterTests(unittest.TestCase):
+    def test_rows_are_written_on_flush(self):
+        target = io.BytesIO()
+        writer = UnicodeWriter(target)
+        writer.writerow([u'task', u'\u201cquoted\u201d, \xfcml\xe4ut'])
+        writer.writerows([[u'note', u''], [u'', u'']])
+        self.assertEqual(target.getvalue(), b'')
+        writer.flush()
+        self.assertEqual(target.getvalue().decode('utf-8'),
+                         u'task,"\u201cquoted\u201d, \xfcml\xe4ut"\r\nnote,\r\n,\r\n')
+
+    def test_buffer_is_flushed_at_flush_size(self):
+        target = io.BytesIO()
+        writer = UnicodeWriter(target, flush_size=100)
+        writer.writerows([u'x' * 10, u'y'] for i in range(50))
+        self.assertGreaterEqual(len(target.getvalue()), 500)
+        writer.flush()
+        self.assertEqual(target.getvalue(), b'xxxxxxxxxx,y\r\n' * 50)
+
+
+class OutputSinkTests(unittest.TestCase):
+    def test_writeline_works_like_print(self):
+        sink = OutputSink.memory()
+        sink.writeline(u'##', u'\xfcml\xe4ut', u'\n')
+        sink.writeline(u'last')
+        self.assertEqual(sink.getvalue().decode('utf-8'), u'## \xfcml\xe4ut \n\nlast\n')
+
+    def test_output_is_buffered(self):
+        sink = OutputSink.memory(buffer_size=10)
+        sink.write(u'12345')
+        self.assertEqual(sink.target.getvalue(), b'')
+        sink.write(u'67890')
+        self.assertEqual(sink.target.getvalue(), b'1234567890')